@@ -7,238 +7,1834 @@
 # License: Vim License (see :help license)
 # Website: https://github.com/troydm/shellasync.vim
 
-import vim, sys, os, re, select, subprocess, threading, signal, time, fcntl
+import vim, sys, os, re, select, subprocess, threading, signal, time, fcntl, errno, codecs, collections, tempfile, mmap, array, bisect, pty, termios, struct, shlex, json, zlib, socket
+
+# python 2 has no selectors module, provide a minimal poll based replacement
+class ShellAsyncSelectorKey(object):
+    def __init__(self,fd,events,data):
+        self.fd = fd
+        self.fileobj = fd
+        self.events = events
+        self.data = data
+
+class ShellAsyncPollSelector(object):
+    def __init__(self):
+        self.poll = select.poll()
+        self.keys = {}
+
+    def register(self,fd,events,data=None):
+        self.keys[fd] = ShellAsyncSelectorKey(fd,events,data)
+        self.poll.register(fd,self.pollMask(events))
+        return self.keys[fd]
+
+    def modify(self,fd,events,data=None):
+        self.keys[fd] = ShellAsyncSelectorKey(fd,events,data)
+        self.poll.modify(fd,self.pollMask(events))
+        return self.keys[fd]
+
+    def unregister(self,fd):
+        self.poll.unregister(fd)
+        return self.keys.pop(fd)
+
+    def pollMask(self,events):
+        mask = 0
+        if events & selectors.EVENT_READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & selectors.EVENT_WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def select(self,timeout=None):
+        if timeout != None:
+            timeout = max(0, int(timeout*1000))
+        try:
+            ready = self.poll.poll(timeout)
+        except select.error:
+            return []
+        ret = []
+        for fd, mask in ready:
+            if fd not in self.keys:
+                continue
+            key = self.keys[fd]
+            events = 0
+            if mask & (select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                events |= selectors.EVENT_READ
+            if mask & (select.POLLOUT | select.POLLHUP | select.POLLERR):
+                events |= selectors.EVENT_WRITE
+            events &= key.events
+            if events == 0:
+                events = key.events
+            ret.append((key, events))
+        return ret
+
+    def close(self):
+        self.keys = {}
+
+class selectors:
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+    DefaultSelector = ShellAsyncPollSelector
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 shellasync_cmds = {}
 shellasync_terms = {}
+shellasync_reactor = None
+shellasync_compressor = None
+shellasync_wakeup = None
+shellasync_liststate = None
+shellasync_detached = set()
+shellasync_evicted = collections.OrderedDict()
+# ShellAsyncTrace while tracing is enabled, hot paths only check it against None otherwise
+shellasync_trace = None
+
+class ShellAsyncTrace(object):
+    # fixed size ring buffer of timed events of hot paths, deque appends are atomic so
+    # both reactor and vim thread add events without locking, oldest events are overwritten
+    __slots__ = ('events', 'started')
 
-class ShellAsyncOutput(threading.Thread):
+    def __init__(self,size):
+        self.events = collections.deque(maxlen=size)
+        self.started = time.time()
+
+    def add(self,name,start,args=None):
+        # complete event of name that started at start and ends now
+        self.events.append((name, start, time.time(), threading.current_thread().ident, args))
+
+    def chrome(self):
+        # events in chrome trace event format, timestamps are in microseconds
+        pid = os.getpid()
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        events = list(self.events)
+        trace = []
+        for tid in set([e[3] for e in events]):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': names.get(tid, str(tid))}})
+        for name, start, end, tid, args in events:
+            event = {'name': name, 'cat': 'shellasync', 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((start-self.started)*1000000.0, 3), 'dur': round((end-start)*1000000.0, 3)}
+            if args != None:
+                event['args'] = args
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+class ShellAsyncReactor(threading.Thread):
+    # single I/O thread that owns the pipes of every running command
+    # the thread only wakes up when a pipe, a process exit or the wakeup fd becomes ready
     def __init__(self):
         threading.Thread.__init__(self)
+        self.name = 'shellasync reactor'
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.pending = []
+        self.dirty = set()
+        self.jobs = []
+        self.signals = []
+        self.stopping = []
+        self.wakeups = 0
+        if hasattr(os, 'eventfd'):
+            self.wakeupr = self.wakeupw = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.wakeupr, self.wakeupw = os.pipe()
+            for fd in (self.wakeupr, self.wakeupw):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.selector.register(self.wakeupr, selectors.EVENT_READ, None)
+
+    def add(self,job):
+        self.lock.acquire()
+        self.pending.append(job)
+        self.lock.release()
+        self.wakeup()
+
+    def notify(self,job):
+        self.lock.acquire()
+        self.dirty.add(job)
+        self.lock.release()
+        self.wakeup()
+
+    def stop(self,job,signum,grace):
+        # signal is sent from reactor thread which is the only one reaping processes,
+        # so process group of job can't be reused by another process before it's signaled
+        self.lock.acquire()
+        self.signals.append((job, signum, grace))
+        self.lock.release()
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeupw, b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        except (IOError, OSError):
+            pass
+
+    def drainWakeup(self):
+        try:
+            while len(os.read(self.wakeupr, 4096)) == 4096:
+                pass
+        except (IOError, OSError):
+            pass
+
+    def timeout(self):
+        # processes that can't be watched through a pidfd need to be reaped periodically
+        # and processes that ignore SIGTERM are killed once their grace period is over
+        timeout = None
+        for job in self.jobs:
+            if job.pidfd == None:
+                timeout = 0.1
+                break
+        if len(self.stopping) > 0:
+            now = time.time()
+            for job in self.stopping:
+                if timeout == None or job.killdeadline-now < timeout:
+                    timeout = max(0.0, job.killdeadline-now)
+        return timeout
+
+    def sendSignal(self,job,signum):
+        try:
+            os.killpg(job.processPid,signum)
+        except OSError:
+            try:
+                os.kill(job.processPid,signum)
+            except OSError:
+                pass
+
+    def fail(self,job,error):
+        # a job that raised is killed and finished on its own so the thread keeps serving other jobs
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if job in self.stopping:
+            self.stopping.remove(job)
+        job.abort(self.selector, error)
+
+    def escalate(self,signals):
+        for job, signum, grace in signals:
+            if job.finished.is_set() or job.processPid == None:
+                continue
+            self.sendSignal(job,signum)
+            if job.stopsignal != signal.SIGKILL:
+                job.stopsignal = signum
+            if job in self.stopping:
+                self.stopping.remove(job)
+            if signum != signal.SIGKILL and grace > 0:
+                job.killdeadline = time.time()+grace
+                self.stopping.append(job)
+        now = time.time()
+        for job in list(self.stopping):
+            if job.finished.is_set():
+                self.stopping.remove(job)
+            elif job.killdeadline <= now:
+                self.sendSignal(job,signal.SIGKILL)
+                job.stopsignal = signal.SIGKILL
+                self.stopping.remove(job)
+
+    def run(self):
+        while True:
+            try:
+                events = self.selector.select(self.timeout())
+            except (IOError, OSError):
+                events = []
+            trace = shellasync_trace
+            if trace != None:
+                start = time.time()
+            self.wakeups += 1
+            ready = set()
+            for key, mask in events:
+                if key.data == None:
+                    self.drainWakeup()
+                else:
+                    try:
+                        key.data.ready(self.selector, key.fd, mask)
+                    except Exception as e:
+                        self.fail(key.data, e)
+                        continue
+                    ready.add(key.data)
+            self.lock.acquire()
+            pending = self.pending
+            self.pending = []
+            ready.update(self.dirty)
+            self.dirty = set()
+            signals = self.signals
+            self.signals = []
+            self.lock.release()
+            for job in pending:
+                try:
+                    job.spawn(self.selector)
+                except Exception as e:
+                    # hand the error over to the thread waiting in startProcess
+                    job.error = e
+                    job.finished.set()
+                    job.started.set()
+                    continue
+                self.lock.acquire()
+                abandoned = job.error != None
+                job.started.set()
+                self.lock.release()
+                if abandoned:
+                    # startProcess gave up waiting for it, nobody would read its output
+                    self.fail(job, job.error)
+                    continue
+                self.jobs.append(job)
+                ready.add(job)
+            for job in list(self.jobs):
+                if job in ready or job.pidfd == None:
+                    try:
+                        if not job.service(self.selector):
+                            job.finish(self.selector)
+                            self.jobs.remove(job)
+                    except Exception as e:
+                        self.fail(job, e)
+            if len(signals) > 0 or len(self.stopping) > 0:
+                self.escalate(signals)
+            if trace != None:
+                trace.add('reactor', start, {'events': len(events), 'jobs': len(self.jobs)})
+
+class ShellAsyncLineFramer(object):
+    # splits a stream of bytes into lines, decoding it incrementally so multibyte
+    # characters split between two reads are preserved, runs in linear time
+    __slots__ = ('decoder', 'partial', 'partiallen', 'compactlen')
+    maxRemainder = 65536
+    minCompact = 4096
+
+    def __init__(self,encoding='utf-8',errors='ignore'):
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.partial = []
+        self.partiallen = 0
+        self.compactlen = self.minCompact
+
+    def feed(self,data,final=False):
+        try:
+            text = self.decoder.decode(data, final)
+        except UnicodeError:
+            # error handler that raises would stop the reactor thread, undecodable bytes are
+            # replaced from now on, decoder keeps its state when decode raises
+            self.decoder.errors = 'replace'
+            text = self.decoder.decode(data, final)
+        return self.feedText(text)
+
+    def feedText(self,text):
+        if text.find("\n") == -1:
+            if len(text) > 0:
+                self.partial.append(text)
+                self.partiallen += len(text)
+            return []
+        lines = text.split("\n")
+        if len(self.partial) > 0:
+            self.partial.append(lines[0])
+            lines[0] = ''.join(self.partial)
+            self.partial = []
+        tail = lines.pop()
+        self.partiallen = len(tail)
+        self.compactlen = self.minCompact
+        if len(tail) > 0:
+            self.partial.append(tail)
+        return lines
+
+    def compact(self,collapse):
+        # replaces long unterminated line with shorter equivalent text returned by collapse
+        # so a progress bar redrawn with carriage returns doesn't grow without bound
+        if self.partiallen <= self.compactlen:
+            return
+        # text after last carriage return might end in the middle of an escape sequence
+        text = ''.join(self.partial)
+        i = text.rfind('\r')
+        if i > 0:
+            text = collapse(text[:i])+text[i:]
+        self.partial = [text]
+        self.partiallen = len(text)
+        self.compactlen = max(self.minCompact, self.partiallen*2)
+
+    def remainder(self):
+        # unterminated line, very long ones are only returned once they're complete
+        if self.partiallen > self.maxRemainder:
+            return ''
+        if len(self.partial) > 1:
+            self.partial = [''.join(self.partial)]
+        if len(self.partial) > 0:
+            return self.partial[0]
+        return ''
+
+    def flush(self):
+        lines = self.feed(b'', True)
+        if len(self.partial) > 0:
+            lines.append(''.join(self.partial))
+            self.partial = []
+            self.partiallen = 0
+        return lines
+
+# ANSI/VT escape sequences and control characters removed from output, CSI sequences
+# capture their parameters and final character which are dispatched by ShellAsyncAnsiParser
+shellasync_ansi_sequence = re.compile(r'(?:\x1b\[|\x9b)([0-?]*)[ -/]*([@-~])?|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)?|\x1b[PX^_][^\x1b]*(?:\x1b\\)?|\x1b[ -/]*[0-~]?|[\x00-\x08\x0b-\x1f\x7f]')
+# CSI sequences moving cursor within a line or erasing it
+shellasync_ansi_cursor = re.compile(r'(?:\x1b\[|\x9b)[0-?]*[ -/]*[CDGK]')
+# highlight group name -> (foreground, background, attributes) of every color style seen in output
+shellasync_ansi_styles = {}
+shellasync_ansi_defined = set()
+shellasync_ansi_mode = None
+shellasync_ansi_attributes = {'b': 'bold', 'i': 'italic', 'u': 'underline', 'r': 'reverse', 's': 'strikethrough'}
+shellasync_ansi_palette = ['#000000', '#cd0000', '#00cd00', '#cdcd00', '#0000ee', '#cd00cd', '#00cdcd', '#e5e5e5',
+                           '#7f7f7f', '#ff0000', '#00ff00', '#ffff00', '#5c5cff', '#ff00ff', '#00ffff', '#ffffff']
+
+class ShellAsyncLine(unicode):
+    # line of output with highlight spans, a list of (byte column, byte length, highlight group)
+    __slots__ = ('spans',)
+
+class ShellAsyncAnsiParser(object):
+    # removes escape sequences from lines of output and turns SGR colors into highlight spans,
+    # runs in reactor thread, colors carry over from one line to the next like on a terminal
+    # carriage returns, backspaces and cursor movements are resolved within a line like a one
+    # line terminal would so only the last frame of a progress bar ends up in output
+    # CSI final character -> method handling the sequence, all other sequences are just removed
+    handlers = {'m': 'sgr', 'C': 'cursorForward', 'D': 'cursorBack', 'G': 'cursorColumn', 'K': 'eraseLine'}
+    controls = {'\r': 'carriageReturn', '\x08': 'backspace'}
+    # SGR code -> attribute it sets and code -> attributes it clears
+    setattributes = {1: 'b', 3: 'i', 4: 'u', 7: 'r', 9: 's'}
+    clearattributes = {22: 'b', 23: 'i', 24: 'u', 27: 'r', 29: 's'}
+    __slots__ = ('colors', 'encoding', 'dispatch', 'transitions', 'groups', 'colored', 'fg', 'bg',
+                 'attributes', 'group', 'chars', 'charGroups', 'col', 'maxColumn')
+
+    def __init__(self,colors=True,encoding='utf-8',columns=None):
+        # columns of pty the command runs on, cursor can't be moved past the last one,
+        # without a pty cursor movements are limited the same way partial lines are
+        self.colors = colors
+        self.encoding = encoding
+        if columns != None and columns > 0:
+            self.maxColumn = columns-1
+        else:
+            self.maxColumn = ShellAsyncLineFramer.maxRemainder
+        self.fg = None
+        self.bg = None
+        self.attributes = ''
+        self.group = None
+        self.groups = {}
+        # (SGR parameters, current group) -> (fg, bg, attributes, group) after the sequence
+        self.transitions = {}
+        self.dispatch = dict([(final, getattr(self, self.handlers[final])) for final in self.handlers])
+        self.dispatch.update([(c, getattr(self, self.controls[c])) for c in self.controls])
+        self.colored = False
+        # characters, their highlight groups and cursor column of line with cursor movements
+        self.chars = []
+        self.charGroups = []
+        self.col = 0
+
+    def parseLines(self,lines):
+        # lines are only parsed one by one if there are any escape sequences or colors carry over,
+        # other control characters are left alone in output without any
+        if self.group == None:
+            text = '\n'.join(lines)
+            if not ('\x1b' in text or u'\x9b' in text or '\x07' in text or '\x08' in text or '\r' in text):
+                return lines
+        return [self.parse(l) for l in lines]
+
+    def parse(self,line):
+        # returns line without escape sequences, ShellAsyncLine with spans if any part of it has colors
+        if line.endswith('\r'):
+            line = line.rstrip('\r')
+        if self.group == None and shellasync_ansi_sequence.search(line) == None:
+            return line
+        if '\r' in line or '\x08' in line or shellasync_ansi_cursor.search(line) != None:
+            return self.parseCursor(line)
+        if not self.colors:
+            return shellasync_ansi_sequence.sub('', line)
+        pieces = []
+        spans = []
+        col = 1
+        pos = 0
+        for m in shellasync_ansi_sequence.finditer(line):
+            if m.start() > pos:
+                col = self.piece(line[pos:m.start()], col, pieces, spans)
+            pos = m.end()
+            if m.group(2) == 'm':
+                self.sgr(m.group(1))
+        if pos < len(line):
+            col = self.piece(line[pos:], col, pieces, spans)
+        return self.line(''.join(pieces), spans)
+
+    def line(self,text,spans):
+        if len(spans) == 0:
+            return text
+        self.colored = True
+        text = ShellAsyncLine(text)
+        text.spans = spans
+        return text
+
+    def peek(self,line):
+        # parses unterminated line without changing state since it's parsed again once it's complete
+        state = (self.fg, self.bg, self.attributes, self.group)
+        text = self.parse(line)
+        self.fg, self.bg, self.attributes, self.group = state
+        return text[:]
+
+    def parseCursor(self,line):
+        self.runCursor(line)
+        chars = self.chars
+        groups = self.charGroups
+        text = ''.join(chars)
+        spans = []
+        if self.colors:
+            col = 1
+            start = 0
+            for i in range(1, len(chars)+1):
+                if i == len(chars) or groups[i] != groups[start]:
+                    length = len(text[start:i].encode(self.encoding, 'replace'))
+                    if groups[start] != None:
+                        spans.append((col, length, groups[start]))
+                    col += length
+                    start = i
+        self.chars = []
+        self.charGroups = []
+        return self.line(text, spans)
+
+    def runCursor(self,line):
+        # runs line through a one line terminal, leaving its characters, their highlight groups
+        # and cursor position in chars, charGroups and col
+        self.chars = []
+        self.charGroups = []
+        self.col = 0
+        pos = 0
+        for m in shellasync_ansi_sequence.finditer(line):
+            if m.start() > pos:
+                self.put(line[pos:m.start()])
+            pos = m.end()
+            final = m.group(2)
+            if final == None:
+                final = m.group(0)
+            handler = self.dispatch.get(final)
+            if handler != None:
+                handler(m.group(1))
+        if pos < len(line):
+            self.put(line[pos:])
+
+    def collapse(self,line):
+        # returns shorter text that gives the same line, colors and cursor position when parsed
+        # from current state as line does, used to keep partial lines of progress bars small
+        if not ('\r' in line or '\x08' in line or shellasync_ansi_cursor.search(line) != None):
+            return line
+        state = (self.fg, self.bg, self.attributes, self.group)
+        self.runCursor(line)
+        chars = self.chars
+        groups = self.charGroups
+        pieces = []
+        start = 0
+        for i in range(1, len(chars)+1):
+            if i == len(chars) or groups[i] != groups[start]:
+                pieces.append(self.sgrSequence(groups[start]))
+                pieces.append(''.join(chars[start:i]))
+                start = i
+        pieces.append(self.sgrSequence(self.group))
+        pieces.append('\r')
+        if self.col > 0:
+            pieces.append('\x1b['+str(self.col)+'C')
+        self.chars = []
+        self.charGroups = []
+        self.fg, self.bg, self.attributes, self.group = state
+        return ''.join(pieces)
+
+    def sgrSequence(self,group):
+        # returns SGR sequence that sets style of highlight group
+        if group == None:
+            return '\x1b[0m'
+        fg, bg, attributes = shellasync_ansi_styles[group]
+        codes = ['0']
+        for a in attributes:
+            for c in self.setattributes:
+                if self.setattributes[c] == a:
+                    codes.append(str(c))
+        for color, base, bright, extended in ((fg, 30, 90, '38'), (bg, 40, 100, '48')):
+            if isinstance(color, str):
+                codes.append(extended+';2;'+';'.join([str(int(color[i:i+2], 16)) for i in (0, 2, 4)]))
+            elif color != None and color < 8:
+                codes.append(str(base+color))
+            elif color != None and color < 16:
+                codes.append(str(bright+color-8))
+            elif color != None:
+                codes.append(extended+';5;'+str(color))
+        return '\x1b['+';'.join(codes)+'m'
+
+    def put(self,text):
+        # writes text at cursor position overwriting what's already there
+        n = len(text)
+        self.col = min(self.col, max(len(self.chars), self.maxColumn))
+        if self.col > len(self.chars):
+            pad = self.col-len(self.chars)
+            self.chars.extend(' '*pad)
+            self.charGroups.extend([None]*pad)
+        self.chars[self.col:self.col+n] = text
+        self.charGroups[self.col:self.col+n] = [self.group]*n
+        self.col += n
+
+    def count(self,params):
+        if params != None and params.isdigit() and int(params) > 0:
+            return int(params)
+        return 1
+
+    def carriageReturn(self,params):
+        self.col = 0
+
+    def backspace(self,params):
+        self.col = max(0, self.col-1)
+
+    def cursorForward(self,params):
+        # text written past the last column wraps so cursor may already be further than that
+        self.col = min(self.col+self.count(params), max(self.col, self.maxColumn))
+
+    def cursorBack(self,params):
+        self.col = max(0, self.col-self.count(params))
+
+    def cursorColumn(self,params):
+        self.col = min(self.count(params)-1, self.maxColumn)
+
+    def eraseLine(self,params):
+        if params == '2':
+            self.chars = []
+            self.charGroups = []
+        elif params == '1':
+            n = min(self.col+1, len(self.chars))
+            self.chars[:n] = ' '*n
+            self.charGroups[:n] = [None]*n
+        else:
+            del self.chars[self.col:]
+            del self.charGroups[self.col:]
+
+    def piece(self,text,col,pieces,spans):
+        pieces.append(text)
+        length = len(text.encode(self.encoding, 'replace'))
+        if self.group != None:
+            spans.append((col, length, self.group))
+        return col+length
+
+    def sgr(self,params):
+        if not self.colors:
+            return
+        key = (params, self.group)
+        if not key in self.transitions:
+            if len(self.transitions) > 4096:
+                self.transitions = {}
+            self.transitions[key] = self.sgrTransition(params)
+        self.fg, self.bg, self.attributes, self.group = self.transitions[key]
+
+    def sgrTransition(self,params):
+        # returns style after SGR sequence with params is applied to current one
+        codes = [int(c) if c.isdigit() else 0 for c in params.replace(':', ';').split(';')]
+        fg = self.fg
+        bg = self.bg
+        attributes = self.attributes
+        i = 0
+        while i < len(codes):
+            c = codes[i]
+            if c == 0:
+                fg = bg = None
+                attributes = ''
+            elif c in self.setattributes:
+                if not self.setattributes[c] in attributes:
+                    attributes = ''.join(sorted(attributes+self.setattributes[c]))
+            elif c in self.clearattributes:
+                attributes = attributes.replace(self.clearattributes[c], '')
+            elif 30 <= c <= 37:
+                fg = c-30
+            elif 90 <= c <= 97:
+                fg = c-82
+            elif 40 <= c <= 47:
+                bg = c-40
+            elif 100 <= c <= 107:
+                bg = c-92
+            elif c == 39:
+                fg = None
+            elif c == 49:
+                bg = None
+            elif (c == 38 or c == 48) and i+1 < len(codes):
+                color = None
+                if codes[i+1] == 5 and i+2 < len(codes):
+                    color = codes[i+2] % 256
+                    i += 2
+                elif codes[i+1] == 2 and i+4 < len(codes):
+                    color = '%02x%02x%02x' % tuple([min(v, 255) for v in codes[i+2:i+5]])
+                    i += 4
+                if c == 38:
+                    fg = color
+                else:
+                    bg = color
+            i += 1
+        if fg == None and bg == None and attributes == '':
+            return (None, None, '', None)
+        style = (fg, bg, attributes)
+        if not style in self.groups:
+            group = 'ShellAsyncAnsi'
+            if fg != None:
+                group += '_f'+str(fg)
+            if bg != None:
+                group += '_b'+str(bg)
+            if attributes != '':
+                group += '_a'+attributes
+            self.groups[style] = group
+            shellasync_ansi_styles[group] = style
+        return (fg, bg, attributes, self.groups[style])
+
+class ShellAsyncLineStore(object):
+    # lines of output packed into one growing UTF-8 bytearray with an array of offsets
+    # where each line ends, lines are consumed from the front by advancing head and their
+    # space is reclaimed once most of the store is consumed, offsets are absolute so
+    # reclaiming doesn't rewrite them, highlight spans are only kept for colored lines
+    __slots__ = ('data', 'ends', 'head', 'base', 'begin', 'removed', 'spans')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array.array('L')
+        # first line not consumed yet, offset of data[0] and offset where ends[0] line starts
+        self.head = 0
+        self.base = 0
+        self.begin = 0
+        # number of lines removed from ends, spans are keyed by line number counted from start
+        self.removed = 0
+        self.spans = {}
+
+    def __len__(self):
+        return len(self.ends)-self.head
+
+    def start(self,index):
+        if index > 0:
+            return self.ends[index-1]
+        return self.begin
+
+    def nbytes(self):
+        return self.base+len(self.data)-self.start(self.head)
+
+    def extend(self,lines,colored=False):
+        ends = self.ends
+        number = self.removed+len(ends)
+        end = self.base+len(self.data)
+        text = '\n'.join(lines)
+        data = text.encode('utf-8', 'surrogatepass')
+        if len(data) == len(text):
+            # ascii only, lengths of lines in bytes are their lengths in characters
+            for l in lines:
+                end += len(l)+1
+                ends.append(end)
+        else:
+            for l in lines:
+                end += len(l.encode('utf-8', 'surrogatepass'))+1
+                ends.append(end)
+        if colored:
+            for i in range(len(lines)):
+                spans = getattr(lines[i], 'spans', None)
+                if spans != None:
+                    self.spans[number+i] = spans
+        if len(lines) > 0:
+            self.data += data
+            self.data += b'\n'
+
+    def view(self,start,end):
+        # zero copy view of lines start to end counted from head, each followed by a newline
+        start = self.start(self.head+start)-self.base
+        end = self.ends[self.head+end-1]-self.base
+        return memoryview(self.data)[start:end]
+
+    def lines(self,start,end):
+        end = min(end, len(self))
+        if start >= end:
+            return []
+        lines = codecs.utf_8_decode(self.view(start,end), 'surrogatepass', True)[0].split('\n')
+        lines.pop()
+        if len(self.spans) > 0:
+            number = self.removed+self.head+start
+            for i in range(len(lines)):
+                spans = self.spans.get(number+i)
+                if spans != None:
+                    lines[i] = ShellAsyncLine(lines[i])
+                    lines[i].spans = spans
+        return lines
+
+    def popleft(self,count):
+        # consume count lines from the front
+        count = min(count, len(self))
+        if len(self.spans) > 0:
+            number = self.removed+self.head
+            for i in range(number, number+count):
+                self.spans.pop(i, None)
+        head = self.head+count
+        if head == len(self.ends):
+            self.clear()
+        elif head > 1024 and head*2 > len(self.ends):
+            start = self.ends[head-1]
+            del self.data[:start-self.base]
+            self.base = start
+            self.begin = start
+            # head is reset before ends shrink so a concurrent len() never sees it negative
+            ends = self.ends[head:]
+            self.removed += head
+            self.head = 0
+            self.ends = ends
+        else:
+            self.head = head
+
+    def trim(self,maxlines,maxbytes):
+        # drops oldest lines so that at most maxlines lines and maxbytes bytes are left,
+        # 0 means no limit, last line is always kept, returns number of dropped lines
+        count = len(self)
+        drop = 0
+        if maxlines > 0 and count > maxlines:
+            drop = count-maxlines
+        if maxbytes > 0 and self.nbytes() > maxbytes:
+            # keep lines starting after the first line ending at least maxbytes before the end
+            drop = max(drop, bisect.bisect_left(self.ends, self.ends[-1]-maxbytes, self.head)+1-self.head)
+        drop = min(drop, count-1)
+        if drop > 0:
+            self.popleft(drop)
+        return max(drop, 0)
+
+    def clear(self):
+        self.removed += len(self.ends)
+        self.head = 0
+        self.ends = array.array('L')
+        self.data = bytearray()
+        self.base = 0
+        self.begin = 0
+        self.spans = {}
+
+class ShellAsyncSpool(object):
+    # complete output lines of a command spooled to an unlinked temporary file
+    # with an index of line offsets, ranges of lines are paged in through mmap
+    __slots__ = ('lock', 'file', 'fd', 'size', 'offsets', 'map')
+
+    def __init__(self):
         self.lock = threading.Lock()
+        self.file = tempfile.TemporaryFile(prefix='shellasync')
+        self.fd = self.file.fileno()
+        self.size = 0
+        self.offsets = array.array('L')
+        self.map = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self,lines):
+        # called from reactor thread, lone surrogates from surrogateescape decoding are
+        # stored as is the same way ShellAsyncLineStore does
+        data = [l.encode('utf-8', 'surrogatepass') for l in lines]
+        offsets = array.array('L')
+        offset = self.size
+        for d in data:
+            offsets.append(offset)
+            offset += len(d)+1
+        data.append(b'')
+        data = memoryview(b'\n'.join(data))
+        while len(data) > 0:
+            data = data[os.write(self.fd, data):]
+        self.lock.acquire()
+        self.offsets.extend(offsets)
+        self.size = offset
+        self.lock.release()
+
+    def view(self):
+        # mmap covering all spooled lines, only used from vim's thread
+        self.lock.acquire()
+        size = self.size
+        offsets = len(self.offsets)
+        self.lock.release()
+        if size > 0 and (self.map == None or len(self.map) < size):
+            if self.map != None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        return (self.map, size, offsets)
+
+    def offset(self,line,size):
+        self.lock.acquire()
+        if line < len(self.offsets):
+            offset = self.offsets[line]
+        else:
+            offset = size
+        self.lock.release()
+        return offset
+
+    def lines(self,start,end):
+        m, size, count = self.view()
+        end = min(end, count)
+        if start >= end:
+            return []
+        data = m[self.offset(start,size):self.offset(end,size)]
+        return data.decode('utf-8', 'surrogatepass').split("\n")[:-1]
+
+    def search(self,pattern,line,backward=False):
+        # search forward from line or backward from the line before it wrapping around
+        # the end, returns (line, byte column) of match or None
+        regex = re.compile(pattern.encode('utf-8', 'surrogatepass'), re.M)
+        m, size, count = self.view()
+        if count == 0:
+            return None
+        start = self.offset(line,size)
+        if backward:
+            match = self.searchLast(regex, m, 0, start)
+            if match == None and start < size:
+                match = self.searchLast(regex, m, start, size)
+        else:
+            match = regex.search(m, start, size)
+            if match == None and start > 0:
+                match = regex.search(m, 0, start)
+        if match == None:
+            return None
+        self.lock.acquire()
+        line = bisect.bisect_right(self.offsets, match.start(), 0, count)-1
+        col = match.start()-self.offsets[line]
+        self.lock.release()
+        return (line, col)
+
+    def searchLast(self,regex,m,start,end):
+        match = None
+        for match in regex.finditer(m, start, end):
+            pass
+        return match
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+# commands made only of these characters that don't start with a shell builtin
+# or keyword are executed directly instead of through /bin/sh
+shellasync_plain_command = re.compile(r'^[A-Za-z0-9_./:,@%+=\- ]*$')
+shellasync_shell_words = set(['.', ':', '[', '!', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'eval', 'exec', 'exit', 'export', 'fg', 'for', 'function', 'getopts', 'hash', 'if', 'jobs', 'kill', 'let', 'local', 'read', 'readonly', 'return', 'select', 'set', 'shift', 'source', 'test', 'time', 'times', 'trap', 'type', 'ulimit', 'umask', 'unalias', 'unset', 'until', 'wait', 'while'])
+
+def ShellAsyncDirectCommand(cmd):
+    # returns argument list if command can be executed without a shell, None otherwise
+    if shellasync_plain_command.match(cmd) == None:
+        return None
+    args = shlex.split(cmd)
+    if len(args) == 0 or args[0] in shellasync_shell_words or '=' in args[0]:
+        return None
+    return args
+
+def ShellAsyncSetControllingTerminal():
+    # runs in child process of a command started on a pseudo terminal
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+class ShellAsyncTimedLock(object):
+    # lock that keeps track of how often and how long threads wait for it and hold it
+    __slots__ = ('lock', 'acquired', 'acquires', 'contended', 'waittime', 'maxwait', 'holdtime', 'maxhold')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0.0
+        self.acquires = 0
+        self.contended = 0
+        self.waittime = 0.0
+        self.maxwait = 0.0
+        self.holdtime = 0.0
+        self.maxhold = 0.0
+
+    def acquire(self):
+        if not self.lock.acquire(False):
+            start = time.time()
+            self.lock.acquire()
+            wait = time.time() - start
+            trace = shellasync_trace
+            if trace != None:
+                trace.add('lock wait', start)
+            self.contended += 1
+            self.waittime += wait
+            if wait > self.maxwait:
+                self.maxwait = wait
+        self.acquires += 1
+        self.acquired = time.time()
+
+    def release(self):
+        hold = time.time() - self.acquired
+        self.holdtime += hold
+        if hold > self.maxhold:
+            self.maxhold = hold
+        self.lock.release()
+
+    def stats(self):
+        self.acquire()
+        ret = {'acquires': self.acquires, 'contended': self.contended, 'wait': self.waittime, 'maxwait': self.maxwait, 'hold': self.holdtime, 'maxhold': self.maxhold}
+        self.release()
+        return ret
+
+class ShellAsyncCommandStats(object):
+    # counters of a command, reactor thread keeps track of the process and its output
+    # and vim thread of refreshing its buffer, each counter has only one writer
+    __slots__ = ('spawned', 'firstbyte', 'exited', 'bytesread', 'linesread', 'reads', 'byteswritten', 'ticks', 'fetchtime')
+
+    def __init__(self):
+        self.spawned = None
+        self.firstbyte = None
+        self.exited = None
+        self.bytesread = 0
+        self.linesread = 0
+        self.reads = 0
+        self.byteswritten = 0
+        self.ticks = 0
+        self.fetchtime = 0.0
+
+    def since(self,t):
+        # milliseconds from spawn to t, -1 if either hasn't happened yet
+        if self.spawned == None or t == None:
+            return -1
+        return round((t-self.spawned)*1000.0, 3)
+
+    def runtime(self):
+        if self.spawned == None:
+            return 0.0
+        if self.exited != None:
+            return self.exited-self.spawned
+        return time.time()-self.spawned
+
+class ShellAsyncStatus(object):
+    # snapshot of process state, reactor thread replaces it as a whole instead of
+    # modifying it so vim can read it without taking a lock
+    __slots__ = ('retval', 'waitingForInput', 'remainder')
+
+    def __init__(self,retval=None,waitingForInput=False,remainder=''):
+        self.retval = retval
+        self.waitingForInput = waitingForInput
+        self.remainder = remainder
+
+class ShellAsyncSummary(object):
+    # what is kept of a finished command once it's evicted, see ShellAsyncEvictCmds
+    __slots__ = ('command', 'retval', 'outcome', 'runtime', 'exited', 'bytesread', 'linesread')
+
+    def __init__(self,out):
+        self.command = out.processCommand()
+        self.retval = out.returnValue()
+        self.outcome = out.stopOutcome()
+        self.runtime = out.stats.runtime()
+        self.exited = out.stats.exited
+        self.bytesread = out.stats.bytesread
+        self.linesread = out.stats.linesread
+
+class ShellAsyncArchive(object):
+    # output of a finished command whose buffer was closed, compressor thread packs it
+    # into independently compressed blocks of about blockSize bytes, small output with
+    # lzma which compresses better and bigger with zlib which is a lot faster
+    __slots__ = ('lock', 'pending', 'blocks', 'codec', 'count', 'size', 'packed')
+    blockSize = 1048576
+    lzmaLimit = 1048576
+
+    def __init__(self,lines):
+        self.lock = threading.Lock()
+        self.pending = lines
+        self.blocks = []
+        self.codec = None
+        self.count = len(lines)
+        self.size = sum([len(l)+1 for l in lines])
+        self.packed = 0
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        if self.pending != None:
+            return self.size
+        return self.packed
+
+    def pack(self,lines):
+        return '\n'.join([l.encode('utf-8') if isinstance(l, unicode) else l for l in lines])
+
+    def unpack(self,data):
+        return data.split('\n')
+
+    def compress(self):
+        # called from compressor thread, blocks end at line boundaries so each one decodes on its own
+        lines = self.pending
+        if lines == None:
+            return
+        data = self.pack(lines)
+        codec = 'lzma' if lzma != None and len(data) <= self.lzmaLimit else 'zlib'
+        blocks = []
+        start = 0
+        while True:
+            end = data.find(b'\n', start+self.blockSize)
+            if end == -1:
+                end = len(data)
+            block = data[start:end]
+            blocks.append(lzma.compress(block) if codec == 'lzma' else zlib.compress(block, 6))
+            start = end+1
+            if start > len(data):
+                break
+        self.lock.acquire()
+        self.blocks = blocks
+        self.codec = codec
+        self.packed = sum([len(b) for b in blocks])
+        self.pending = None
+        self.lock.release()
+
+    def lines(self):
+        # called from vim thread, decompresses one block at a time
+        self.lock.acquire()
+        pending = self.pending
+        blocks = self.blocks
+        codec = self.codec
+        self.lock.release()
+        if pending != None:
+            return list(pending)
+        lines = []
+        for block in blocks:
+            lines.extend(self.unpack(lzma.decompress(block) if codec == 'lzma' else zlib.decompress(block)))
+        return lines
+
+class ShellAsyncCompressor(threading.Thread):
+    # compresses archives in background so closing a buffer doesn't wait for it,
+    # zlib and lzma release the GIL while they compress
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.name = 'shellasync compressor'
+        self.daemon = True
+        self.queue = collections.deque()
+        self.event = threading.Event()
+
+    def add(self,archive):
+        self.queue.append(archive)
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            while len(self.queue) > 0:
+                archive = self.queue.popleft()
+                trace = shellasync_trace
+                if trace != None:
+                    start = time.time()
+                archive.compress()
+                if trace != None:
+                    trace.add('compress', start, {'lines': len(archive), 'bytes': archive.size, 'packed': archive.packed, 'codec': archive.codec})
+
+def ShellAsyncGetCompressor():
+    global shellasync_compressor
+    if shellasync_compressor == None or not shellasync_compressor.is_alive():
+        shellasync_compressor = ShellAsyncCompressor()
+        shellasync_compressor.start()
+    return shellasync_compressor
+
+class ShellAsyncQuietInput(str):
+    # input written to a command without being echoed to its output
+    __slots__ = ()
+
+class ShellAsyncWakeup(object):
+    # local socket vim is connected to through a channel, reactor thread writes a byte to it
+    # when output changes while vim's refresh timer is armed to be woken up, so the timer
+    # doesn't have to poll commands that are running without producing any output
+    __slots__ = ('server', 'conn', 'armed')
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.conn = None
+        self.armed = False
+
+    def port(self):
+        return self.server.getsockname()[1]
+
+    def accept(self,connected):
+        # vim thread, called once vim tried to connect to port
+        if connected:
+            self.server.settimeout(1.0)
+            try:
+                self.conn = self.server.accept()[0]
+                self.conn.setblocking(False)
+            except (socket.error, socket.timeout):
+                self.conn = None
+        self.server.close()
+
+    def ready(self):
+        return self.conn != None
+
+    def arm(self):
+        # vim thread, next change of output wakes vim up
+        self.armed = True
+
+    def wake(self):
+        # reactor thread, armed is cleared before sending so a change after it arms it again
+        if not self.armed:
+            return
+        self.armed = False
+        conn = self.conn
+        if conn == None:
+            return
+        try:
+            conn.send(b'\n')
+        except (socket.error, IOError, OSError) as e:
+            if e.errno != errno.EAGAIN:
+                # vim closed channel, refresh timer falls back to polling
+                self.conn = None
+
+def ShellAsyncGetWakeup():
+    global shellasync_wakeup
+    if shellasync_wakeup == None:
+        shellasync_wakeup = ShellAsyncWakeup()
+    return shellasync_wakeup
+
+def ShellAsyncWake():
+    # called from reactor thread whenever output or state of a command changed
+    wakeup = shellasync_wakeup
+    if wakeup != None:
+        wakeup.wake()
+
+def ShellAsyncGetReactor():
+    global shellasync_reactor
+    if shellasync_reactor == None or not shellasync_reactor.is_alive():
+        shellasync_reactor = ShellAsyncReactor()
+        shellasync_reactor.start()
+    return shellasync_reactor
+
+class ShellAsyncOutput(object):
+    __slots__ = ('lock', 'finished', 'started', 'error', 'process', 'processPid', 'pty', 'direct',
+                 'stdinfd', 'stdoutfd', 'pidfd', 'command', 'cwd', 'env', 'print_retval', 'status',
+                 'output', 'fetched', 'scrollback', 'scrollbackbytes', 'dropped', 'spool', 'outputrem',
+                 'outputremc', 'newdata', 'input', 'inputtotal', 'inputdone', 'remainder', 'framer',
+                 'ansi', 'outread', 'eof', 'exited', 'pending', 'pendingwatched', 'stats',
+                 'stoprequested', 'stopsignal', 'killdeadline', 'stopreported', 'lastused', 'archive', 'sentinel', 'framestatus',
+                 'pendingrem')
+    maxInputWrite = 262144
+    # seconds vim waits for reactor thread to start a process before reporting it as failed
+    spawnTimeout = 2.0
+
+    # command, cwd, env and pid don't change once process is started so they are read without locking,
+    # process state is published through status, lock only protects output waiting to be fetched
+    # and is held just long enough to hand it over, see ShellAsyncTimedLock for its statistics
+    def __init__(self):
+        self.lock = ShellAsyncTimedLock()
+        self.finished = threading.Event()
+        self.started = threading.Event()
+        self.error = None
+        self.process = None
         self.processPid = None
+        self.pty = None
+        self.direct = True
+        self.stdinfd = None
+        self.stdoutfd = None
+        self.pidfd = None
         self.command = None
         self.cwd = None
         self.env = None
         self.print_retval = False
-        self.retval = None
-        self.output = []
+        self.status = ShellAsyncStatus()
+        self.output = ShellAsyncLineStore()
+        # output already handed over to vim thread but not yet fetched, only accessed by vim thread
+        self.fetched = ShellAsyncLineStore()
+        self.scrollback = 0
+        self.scrollbackbytes = 0
+        self.dropped = 0
+        self.spool = None
         self.outputrem = False
         self.outputremc = False
+        # remainder held back while complete lines wait to be fetched, queued by get once they are
+        self.pendingrem = None
         self.newdata = False
-        self.input = []
-        self.waitingForInput = False
+        # deque is safe to append to from vim thread and pop from reactor thread without locking,
+        # inputtotal is only modified by vim thread and inputdone by reactor thread
+        self.input = collections.deque()
+        self.inputtotal = 0
+        self.inputdone = 0
         self.remainder = ''
+        self.framer = None
+        self.ansi = ShellAsyncAnsiParser(False)
+        self.outread = []
+        self.eof = False
+        self.exited = False
+        # encoded input waiting to be written as [data, offset, characters], data None closes stdin
+        self.pending = collections.deque()
+        self.pendingwatched = False
+        self.stats = ShellAsyncCommandStats()
+        # set by vim thread when it asks to stop the process, signal sent to stop it and
+        # when it's killed if it doesn't exit are only modified by reactor thread
+        self.stoprequested = False
+        self.stopsignal = None
+        self.killdeadline = None
+        self.stopreported = False
+        # when vim last showed or fetched output of this command, only accessed by vim thread
+        self.lastused = time.time()
+        # ShellAsyncArchive of output shown in closed buffer, only accessed by vim thread
+        self.archive = None
+        # marker a persistent shell prints after each framed command and (exit status, cwd)
+        # of the last one published by reactor thread once its output is extended, see writeFramed
+        self.sentinel = None
+        self.framestatus = None
 
-    def startProcess(self,cmd,cwd,env,print_retval):
-        self.lock.acquire()
+    def startProcess(self,cmd,cwd,env,print_retval,encoding='utf-8',errors='ignore',scrollback=0,scrollbackbytes=0,spool=False,pty=None,direct=True,colors=True):
+        # pty is None to use pipes or (rows, columns, TERM) to run command on a pseudo terminal
+        # direct allows executing simple commands without /bin/sh
+        # colors keeps SGR colors of output as highlight, otherwise they are removed
+        self.pty = pty
+        self.direct = direct
+        self.framer = ShellAsyncLineFramer(encoding,errors)
+        self.ansi = ShellAsyncAnsiParser(colors, columns=pty[1] if pty != None else None)
+        if spool:
+            self.spool = ShellAsyncSpool()
+        self.scrollback = scrollback
+        self.scrollbackbytes = scrollbackbytes
         self.command = cmd
         self.cwd = cwd
         self.env = env
         self.print_retval = print_retval
-        self.lock.release()
-        self.start()
-        time.sleep(0.0000001)
-        i = 0
-        pid = None
-        while True:
-            pid = self.pid()
-            if i >= 1000 or pid != None:
-                return pid
-            time.sleep(0.001)
-            i += 1
-        return None
-    
-    def run(self):
-        self.lock.acquire()
-        p = subprocess.Popen(self.command+" 2>&1", shell=True, cwd=self.cwd, env=self.env, preexec_fn=os.setsid, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        fcntl.fcntl(p.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-        if 'poll' in dir(select):
-            pl = select.poll()
-            pl.register(p.stdout)
-        else:
-            pl = None
-            # kq = select.kevent(p.stdout.fileno(),filter=select.KQ_FILTER_READ)
+        # reactor sets started once the process is forked or spawning it failed, vim isn't
+        # blocked for longer than spawnTimeout if reactor thread died or is stuck
+        reactor = ShellAsyncGetReactor()
+        reactor.add(self)
+        deadline = time.time()+self.spawnTimeout
+        while not self.started.wait(0.05):
+            alive = reactor.is_alive()
+            if alive and time.time() < deadline:
+                continue
+            reactor.lock.acquire()
+            if not self.started.is_set():
+                if self in reactor.pending:
+                    reactor.pending.remove(self)
+                if alive:
+                    self.error = RuntimeError("reactor thread didn't start it in "+str(self.spawnTimeout)+" seconds")
+                else:
+                    self.error = RuntimeError("reactor thread isn't running")
+                self.finished.set()
+            reactor.lock.release()
+            break
+        if self.error != None:
+            return None
+        return self.pid()
+
+    def spawn(self,selector):
+        # called from reactor thread
+        self.stats.spawned = time.time()
+        if self.pty != None:
+            master, slave = pty.openpty()
+            try:
+                # output newlines aren't translated to \r\n
+                attrs = termios.tcgetattr(slave)
+                attrs[1] &= ~termios.ONLCR
+                termios.tcsetattr(slave, termios.TCSANOW, attrs)
+                fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', self.pty[0], self.pty[1], 0, 0))
+                env = dict(self.env if self.env != None else os.environ)
+                env['TERM'] = self.pty[2]
+                env['LINES'] = str(self.pty[0])
+                env['COLUMNS'] = str(self.pty[1])
+                p = subprocess.Popen(self.command, shell=True, cwd=self.cwd, env=env, preexec_fn=ShellAsyncSetControllingTerminal, stdin=slave, stdout=slave, stderr=slave)
+            except:
+                os.close(master)
+                raise
+            finally:
+                os.close(slave)
+            self.stdinfd = self.stdoutfd = master
+        else:
+            # start command in a new session
+            p = None
+            args = ShellAsyncDirectCommand(self.command) if self.direct else None
+            if args != None:
+                try:
+                    p = subprocess.Popen(args, cwd=self.cwd, env=self.env, preexec_fn=os.setsid, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                except (IOError, OSError) as e:
+                    # let the shell report commands that can't be found or executed
+                    if e.errno not in (errno.ENOENT, errno.EACCES, errno.ENOEXEC):
+                        raise
+            if p == None:
+                p = subprocess.Popen(self.command, shell=True, cwd=self.cwd, env=self.env, preexec_fn=os.setsid, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.stdinfd = p.stdin.fileno()
+            self.stdoutfd = p.stdout.fileno()
+            fcntl.fcntl(self.stdinfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        fcntl.fcntl(self.stdoutfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        selector.register(self.stdoutfd, selectors.EVENT_READ, self)
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self.pidfd = os.pidfd_open(p.pid)
+                selector.register(self.pidfd, selectors.EVENT_READ, self)
+            except (IOError, OSError):
+                self.pidfd = None
+        self.process = p
         self.processPid = p.pid
-        self.lock.release()
-        retval = None
-        out = ''
+
+    def ready(self,selector,fd,mask):
+        # called from reactor thread when stdout or pidfd is readable or stdin is writable
+        # queued input is written afterwards by service
+        if fd == self.pidfd:
+            selector.unregister(fd)
+            self.exited = True
+        elif fd == self.stdoutfd and mask & selectors.EVENT_READ:
+            self.read()
+            if self.eof:
+                selector.unregister(fd)
+                if fd == self.stdinfd:
+                    # pseudo terminal is gone, input can't be written anymore
+                    self.pendingwatched = False
+                    self.dropInput()
+
+    def read(self):
+        # called from reactor thread, reads everything currently available on stdout
+        # reading pseudo terminal fails with EIO once command exits, treat it as end of output
+        fd = self.stdoutfd
+        trace = shellasync_trace
+        if trace != None:
+            start = time.time()
+        chunks = []
+        stats = self.stats
         while True:
+            stats.reads += 1
             try:
-                canWrite = False
-                if pl != None:
-                    plr = pl.poll(50)
-                    if len(plr) == 0:
-                        outread = ''
-                    else:
-                        plr = plr[0][1]
-                        try:
-                            if plr & select.POLLIN or plr & select.POLLPRI:
-                                outread = p.stdout.read()
-                            else:
-                                outread = ''
-                        except IOError:
-                            outread = ''
-                    canWrite = type(plr) == list or (pl != None and (plr & select.POLLOUT) > 0)
-                else:
-                    try:
-                        outread = p.stdout.read()
-                    except IOError:
-                        outread = ''
-                    canWrite = True
-                if len(outread) == 0 and canWrite:
-                    wr = self.getWrite()
-                    if wr != None:
-                        if wr == "\x04":
-                            p.stdin.close()
-                        else:
-                            p.stdin.write(wr)
-                            p.stdin.flush()
-                            outread += wr
-                        time.sleep(0.001)
-                if len(outread) == 0:
-                    retval = p.poll()
-                    if retval != None:
-                        self.lock.acquire()
-                        self.waitingForInput = False
-                        self.retval = retval
-                        self.lock.release()
-                        break
-                    else:
-                        if len(out) > 0:
-                            self.extendrem(out)
-                        self.lock.acquire()
-                        self.waitingForInput = True
-                        self.lock.release()
-                        time.sleep(0.01)
-                else:
-                    self.lock.acquire()
-                    self.waitingForInput = False
-                    self.lock.release()
-                    out += outread
-                    while out.find("\n") != -1:
-                        out = out.split("\n")
-                        lines = out[:-1]
-                        out = out[-1]
-                        self.extend(lines)
-                    if len(out) > 0:
-                        self.extendrem(out)
-                        self.lock.acquire()
-                        self.waitingForInput = True
-                        self.lock.release()
-            except IOError:
-                time.sleep(0.01)
-        if pl != None:
-            pl.unregister(p.stdout)
-        if len(out) > 0:
-            while out.find("\n") != -1:
-                out = out.split("\n")
-                lines = out[:-1]
-                out = out[-1]
-                self.extend(lines)
-            if len(out) > 0:
-                self.extend([out])
+                data = os.read(fd, 65536)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                data = b''
+            if len(data) == 0:
+                self.eof = True
+                break
+            stats.bytesread += len(data)
+            chunks.append(data)
+        if stats.firstbyte == None and len(chunks) > 0:
+            stats.firstbyte = time.time()
+        self.outread.extend(chunks)
+        if trace != None:
+            trace.add('read', start, {'pid': self.processPid, 'chunks': len(chunks)})
+
+    def service(self,selector):
+        # called from reactor thread after any event for this job, returns False when process has finished
+        p = self.process
+        lines = []
+        if len(self.outread) > 0:
+            trace = shellasync_trace
+            if trace != None:
+                start = time.time()
+            lines = self.framer.feed(b''.join(self.outread))
+            self.outread = []
+            self.stats.linesread += len(lines)
+            if trace != None:
+                trace.add('decode', start, {'pid': self.processPid, 'lines': len(lines)})
+        wr = self.getWrite()
+        while wr != None:
+            if wr == "\x04" and self.pty == None:
+                self.pending.append([None, 0, len(wr)])
+            else:
+                self.pending.append([wr.encode('utf-8'), 0, len(wr)])
+                if self.pty == None and type(wr) != ShellAsyncQuietInput:
+                    # pseudo terminal echoes input by itself
+                    lines.extend(self.framer.feedText(wr.decode('utf-8', 'ignore')))
+            wr = self.getWrite()
+        if len(self.pending) > 0:
+            self.writeInput(selector)
+        if len(lines) > 0:
+            self.extend(lines)
+        if self.exited or (self.pidfd == None and p.poll() != None):
+            return False
+        self.framer.compact(self.ansi.collapse)
+        remainder = self.framer.remainder()
+        if len(remainder) > 0:
+            self.extendrem(remainder)
+        if not self.status.waitingForInput or self.status.remainder != self.remainder:
+            self.status = ShellAsyncStatus(None, True, self.remainder)
+            # remainder queued by extendrem or command started waiting for input
+            ShellAsyncWake()
+        return True
+
+    def writeInput(self,selector):
+        # called from reactor thread, writes queued input until stdin would block or
+        # maxInputWrite bytes were written so reading output isn't held up by a big paste
+        written = 0
+        done = 0
+        while len(self.pending) > 0 and written < self.maxInputWrite:
+            data, offset, chars = self.pending[0]
+            if self.stdinfd == None:
+                self.dropInput()
+                break
+            if data == None:
+                self.watchInput(selector, False)
+                try:
+                    self.process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                self.stdinfd = None
+                self.pending.popleft()
+                done += chars
+                continue
+            item = self.pending[0]
+            try:
+                n = os.write(self.stdinfd, data[offset:offset+self.maxInputWrite])
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                # process closed its stdin, rest of input is discarded
+                self.dropInput()
+                break
+            written += n
+            item[1] += n
+            if item[1] >= len(data):
+                self.pending.popleft()
+                done += chars
+        self.stats.byteswritten += written
+        self.inputdone += done
+        self.watchInput(selector, len(self.pending) > 0)
+
+    def watchInput(self,selector,watch):
+        # called from reactor thread, waits for stdin to become writable while input is pending
+        if watch == self.pendingwatched or self.stdinfd == None:
+            return
+        self.pendingwatched = watch
+        if self.stdinfd == self.stdoutfd:
+            if self.eof:
+                return
+            events = selectors.EVENT_READ
+            if watch:
+                events |= selectors.EVENT_WRITE
+            selector.modify(self.stdinfd, events, self)
+        elif watch:
+            selector.register(self.stdinfd, selectors.EVENT_WRITE, self)
+        else:
+            selector.unregister(self.stdinfd)
+
+    def dropInput(self):
+        # called from reactor thread when input can no longer be written
+        done = 0
+        for item in self.pending:
+            done += item[2]
+        self.pending.clear()
+        wr = self.getWrite()
+        while wr != None:
+            done += len(wr)
+            wr = self.getWrite()
+        self.inputdone += done
+
+    def finish(self,selector):
+        # called from reactor thread after process has exited
+        self.stats.exited = time.time()
+        p = self.process
+        if not self.eof:
+            self.read()
+            selector.unregister(self.stdoutfd)
+        if self.pendingwatched and self.stdinfd != self.stdoutfd:
+            selector.unregister(self.stdinfd)
+        self.pendingwatched = False
+        self.dropInput()
+        if self.pidfd != None:
+            if not self.exited:
+                selector.unregister(self.pidfd)
+            os.close(self.pidfd)
+        lines = self.framer.feed(b''.join(self.outread))
+        lines.extend(self.framer.flush())
+        self.outread = []
+        self.stats.linesread += len(lines)
+        if len(lines) > 0:
+            self.extend(lines)
+        retval = p.wait()
+        if self.pty != None:
+            os.close(self.stdoutfd)
+        for f in (p.stdin, p.stdout, p.stderr):
+            try:
+                if f != None:
+                    f.close()
+            except (IOError, OSError):
+                pass
+        lines = []
+        if self.stopsignal != None:
+            lines.append("Shell command "+self.command+" "+self.stopOutcome())
         if self.print_retval:
-            self.extend(["","Shell command "+self.command+" completed with exit status "+str(retval)])
+            lines.append("Shell command "+self.command+" completed with exit status "+str(retval))
+        if len(lines) > 0:
+            self.extend([""]+lines)
+        self.status = ShellAsyncStatus(retval, False, '')
+        self.finished.set()
+        ShellAsyncWake()
+
+    def abort(self,selector,error):
+        # called from reactor thread when handling this job raised error, releases whatever
+        # finish would and reports the error in output instead of raising it again
+        fds = [self.stdoutfd, self.stdinfd]
+        if not self.exited:
+            fds.append(self.pidfd)
+        for fd in fds:
+            try:
+                if fd != None:
+                    selector.unregister(fd)
+            except (KeyError, ValueError, IOError, OSError):
+                pass
+        self.pendingwatched = False
+        self.eof = True
+        self.outread = []
+        self.pending.clear()
+        self.input.clear()
+        p = self.process
+        retval = -1
+        if p != None:
+            try:
+                os.killpg(self.processPid,signal.SIGKILL)
+            except OSError:
+                try:
+                    os.kill(self.processPid,signal.SIGKILL)
+                except OSError:
+                    pass
+            try:
+                retval = p.wait()
+            except (IOError, OSError):
+                pass
+            for f in (p.stdin, p.stdout, p.stderr):
+                try:
+                    if f != None:
+                        f.close()
+                except (IOError, OSError):
+                    pass
+        for fd in (self.pidfd, self.stdoutfd if self.pty != None else None):
+            try:
+                if fd != None:
+                    os.close(fd)
+            except (IOError, OSError):
+                pass
+        message = "Shell command "+str(self.command)+" failed: "+type(error).__name__+": "+str(error)
+        self.lock.acquire()
+        self.newdata = True
+        if self.outputrem:
+            self.output.clear()
+        self.outputremc = self.outputrem or self.outputremc
+        self.outputrem = False
+        self.pendingrem = None
+        self.output.extend(["", message])
+        self.lock.release()
+        self.stats.exited = time.time()
+        self.status = ShellAsyncStatus(retval, False, '')
+        self.finished.set()
+        ShellAsyncWake()
 
     def isAlive(self):
-        return self.is_alive()
+        return not self.finished.is_set()
+
+    def stop(self,signum,grace=0):
+        # asks reactor thread to send signum to process group and SIGKILL if it's still running after grace seconds
+        self.stoprequested = True
+        ShellAsyncGetReactor().stop(self,signum,grace)
+
+    def isStopping(self):
+        return self.stoprequested and self.isAlive()
+
+    def stopOutcome(self):
+        if self.stopsignal == signal.SIGKILL:
+            return "killed"
+        elif self.stopsignal != None:
+            return "terminated"
+        return "finished"
+
+    def join(self,timeout=None):
+        self.finished.wait(timeout)
 
     def isRunning(self):
-        self.lock.acquire()
-        ret = self.retval == None
-        self.lock.release()
-        return ret
+        return self.status.retval == None
 
     def isWaitingForInput(self):
-        self.lock.acquire()
-        ret = len(self.input) == 0 and self.waitingForInput
-        self.lock.release()
-        return ret
+        return self.inputdone == self.inputtotal and self.status.waitingForInput
 
     def getRemainder(self):
+        return self.status.remainder
+
+    def get(self,maxlines=0):
+        # returns at most maxlines lines waiting to be fetched, all of them if maxlines is 0
+        # called from vim thread, output is swapped out under the lock and drained without holding it
+        if len(self.fetched) > 0:
+            return (False, False, self.drain(maxlines), 0)
         self.lock.acquire()
-        if self.waitingForInput:
-            ret = self.remainder
-        else:
-            ret = '' 
+        if len(self.output) == 0 and self.pendingrem != None:
+            self.output.extend([self.pendingrem])
+            self.outputremc = not self.outputrem
+            self.outputrem = True
+            self.pendingrem = None
+        if len(self.output) == 0:
+            self.newdata = False
+            self.lock.release()
+            return None
+        self.fetched = self.output
+        self.output = ShellAsyncLineStore()
+        rem = self.outputrem
+        remc = self.outputremc
+        dropped = self.dropped
+        self.outputremc = False
+        self.dropped = 0
+        self.newdata = False
         self.lock.release()
-        return ret
+        if rem:
+            # remainder always comes alone
+            return (rem, remc, self.drain(0), dropped)
+        return (rem, remc, self.drain(maxlines), dropped)
 
-    def get(self):
-        r = None
+    def drain(self,maxlines):
+        # called from vim thread, takes lines out of already fetched output
+        trace = shellasync_trace
+        if trace != None:
+            start = time.time()
+        if maxlines <= 0:
+            maxlines = len(self.fetched)
+        lines = self.fetched.lines(0, maxlines)
+        self.fetched.popleft(len(lines))
+        if trace != None:
+            trace.add('get', start, {'pid': self.processPid, 'lines': len(lines)})
+        return lines
+
+    def spoolSnapshot(self):
+        # discard output waiting to be fetched since it's already in the spool
+        # and return number of spooled lines that vim has to show
+        self.fetched = ShellAsyncLineStore()
         self.lock.acquire()
         self.newdata = False
-        if len(self.output) > 0:
-            r = (self.outputrem, self.outputremc, self.output)
-            self.outputremc = False
-            self.output = []
+        self.outputremc = False
+        self.output = ShellAsyncLineStore()
+        self.dropped = 0
         self.lock.release()
-        return r
+        return len(self.spool)
+
+    def close(self):
+        if self.spool != None:
+            self.spool.close()
+            self.spool = None
 
     def hasdata(self):
-        self.lock.acquire()
-        r = len(self.output) > 0
-        self.lock.release()
-        return r
+        return len(self.fetched) > 0 or len(self.output) > 0 or self.pendingrem != None
+
+    def retained(self):
+        # bytes of output kept in memory
+        size = self.output.nbytes()+self.fetched.nbytes()
+        if self.archive != None:
+            size += self.archive.nbytes()
+        return size
+
+    def retain(self,lines):
+        # keeps output of finished command compressed once its buffer is closed
+        while self.hasdata():
+            lines.extend(self.get()[2])
+        self.archive = ShellAsyncArchive(lines)
+        ShellAsyncGetCompressor().add(self.archive)
+
+    def restore(self):
+        archive = self.archive
+        self.archive = None
+        return archive.lines()
 
     def hasnewdata(self):
-        self.lock.acquire()
-        r = self.newdata
-        self.lock.release()
-        return r
+        return len(self.fetched) > 0 or self.newdata
+
+    def lockStats(self):
+        return self.lock.stats()
+
+    def statistics(self):
+        # counters of this command as a dictionary that can be returned to vim, times are in milliseconds
+        stats = self.stats
+        lock = self.lock.stats()
+        runtime = stats.runtime()
+        return {'pid': self.processPid if self.processPid != None else -1,
+                'command': self.command,
+                'running': int(self.isAlive()),
+                'bytes_read': stats.bytesread,
+                'lines_read': stats.linesread,
+                'reads': stats.reads,
+                'bytes_written': stats.byteswritten,
+                'first_byte_ms': stats.since(stats.firstbyte),
+                'exit_ms': stats.since(stats.exited),
+                'runtime_ms': round(runtime*1000.0, 3),
+                'bytes_per_second': round(stats.bytesread/runtime, 1) if runtime > 0 else 0.0,
+                'lines_per_second': round(stats.linesread/runtime, 1) if runtime > 0 else 0.0,
+                'lock_acquires': lock['acquires'],
+                'lock_contended': lock['contended'],
+                'lock_wait_ms': round(lock['wait']*1000.0, 3),
+                'refresh_ticks': stats.ticks,
+                'fetch_ms': round(stats.fetchtime*1000.0, 3)}
 
     def extend(self,data):
-        # remove ANSI escape sequences
-        for d in data:
-            if "\033" in d:
-                r = re.compile("\033\[\d*;?\d*[A-KST]")
-                data = map(lambda i: r.sub("",i), data)
-                break
+        # called from reactor thread, escape sequences are removed and colors turned into highlight spans
+        trace = shellasync_trace
+        if trace != None:
+            start = time.time()
+        status = None
+        if self.sentinel != None:
+            data, status = self.unframe(data)
+        data = self.ansi.parseLines(data)
+        if self.spool != None:
+            self.spool.append(data)
         self.lock.acquire()
         self.newdata = True
         if self.outputrem:
-            self.output = []
+            self.output.clear()
         self.outputremc = self.outputrem or self.outputremc
         self.outputrem = False
-        self.output.extend(data)
+        self.pendingrem = None
+        self.output.extend(data, self.ansi.colored)
+        if self.scrollback > 0 or self.scrollbackbytes > 0:
+            # drop oldest lines not yet fetched by vim when scrollback limit is exceeded
+            self.dropped += self.output.trim(self.scrollback, self.scrollbackbytes)
         self.lock.release()
+        if status != None:
+            self.framestatus = status
+        ShellAsyncWake()
+        if trace != None:
+            trace.add('extend', start, {'pid': self.processPid, 'lines': len(data)})
+
+    def writeFramed(self,command,token):
+        # runs command in persistent shell followed by printing token, its exit status and working
+        # directory on a line of its own, shell reads the whole line before running it so the
+        # command can't read the marker from stdin, eval is run through command so a syntax
+        # error doesn't exit the shell like it would for a special builtin
+        self.sentinel = token
+        self.framestatus = None
+        self.writeQuiet("command eval '"+command.replace("'", "'\\''")+"'; __shellasync_status=$?; printf '%s%d:%s\\n' '"+token+"' $__shellasync_status \"$PWD\"\n")
+
+    def writeQuiet(self,data):
+        # written as is without showing it in output
+        self.inputtotal += len(data)
+        self.input.append(ShellAsyncQuietInput(data))
+        ShellAsyncGetReactor().notify(self)
+
+    def unframe(self,data):
+        # called from reactor thread, removes marker line of framed command from output, text
+        # before marker is output of command that didn't end with a newline
+        token = self.sentinel
+        if len(data) == 0 or (not token in data[-1] and not token in '\n'.join(data)):
+            return (data, None)
+        for i in range(len(data)-1, -1, -1):
+            j = data[i].rfind(token)
+            if j == -1:
+                continue
+            status, _, cwd = data[i][j+len(token):].partition(':')
+            if j > 0:
+                data[i] = data[i][:j]
+            else:
+                data.pop(i)
+            try:
+                return (data, (int(status), cwd))
+            except ValueError:
+                return (data, (-1, cwd))
+        return (data, None)
 
     def extendrem(self,data):
-        # remove ANSI escape sequences
-        if "\033" in data:
-            r = re.compile("\033\[\d*;?\d*[A-KST]")
-            data = r.sub("", data)
+        # remainder is shown without colors, it's parsed again once the line is complete
+        data = self.ansi.peek(data)
+        if data == self.remainder and self.outputrem:
+            return
         self.lock.acquire()
+        if self.outputrem and len(self.output) > 0:
+            # previous frame of this line wasn't fetched yet, only the latest one is shown
+            self.output.clear()
+            self.output.extend([data])
+            self.lock.release()
+            self.remainder = data
+            return
         if len(self.output) > 0:
+            # remainder always comes alone, reactor may not wake up again so it's left for get
+            self.pendingrem = data
             self.lock.release()
+            self.remainder = data
             return
+        self.newdata = True
         self.outputremc = not self.outputrem
         self.outputrem = True
-        self.remainder = data
-        if len(self.output) > 0:
-            self.output[0] = data
-        else:
-            self.output.append(data)
+        self.output.extend([data])
         self.lock.release()
+        self.remainder = data
+
+    def spawnError(self):
+        if self.error == None:
+            return ''
+        return str(self.error)
 
     def pid(self):
-        self.lock.acquire()
-        pid = self.processPid
-        self.lock.release()
-        return pid
+        return self.processPid
 
     def returnValue(self):
-        self.lock.acquire()
-        retval = self.retval
-        self.lock.release()
-        return retval
+        return self.status.retval
 
     def processCommand(self):
-        self.lock.acquire()
-        command = self.command
-        self.lock.release()
-        return command
+        return self.command
 
     def write(self,data):
         if data == None:
@@ -253,26 +1849,44 @@ class ShellAsyncOutput(threading.Thread):
     def writenonl(self,data):
         if data == None:
             return
-        self.lock.acquire()
-        if type(data) == list:
-            self.input.extend(data)
-        else:
-            self.input.append(data)
-        self.lock.release()
+        if type(data) != list:
+            data = [data]
+        # consecutive lines are joined so a big paste is encoded and written in large chunks
+        chunks = []
+        chunk = []
+        for wr in data:
+            if wr == "\x04":
+                if len(chunk) > 0:
+                    chunks.append(''.join(chunk))
+                    chunk = []
+                chunks.append(wr)
+            else:
+                chunk.append(wr)
+        if len(chunk) > 0:
+            chunks.append(''.join(chunk))
+        for wr in chunks:
+            self.inputtotal += len(wr)
+            self.input.append(wr)
+        ShellAsyncGetReactor().notify(self)
 
     def getWrite(self):
-        out = None
-        self.lock.acquire()
-        if len(self.input) > 0:
-            out = self.input.pop(0)
-        self.lock.release()
-        return out
+        try:
+            return self.input.popleft()
+        except IndexError:
+            return None
+
+    def inputProgress(self):
+        # returns number of characters of input written to process and total number queued
+        return (self.inputdone, self.inputtotal)
 
 class ShellAsyncTerminal:
     def __init__(self):
         self.cwd = vim.eval('getcwd()')
         self.env = dict(os.environ)
         self.pid = None
+        # pid of persistent shell running commands when g:shellasync_terminal_persistent is set
+        self.shell = None
+        self.token = '__shellasync_'+('%016x' % struct.unpack('Q', os.urandom(8))[0])+'__'
         self.history = []
         self.historyind = -1
         self.sendhistory = []
@@ -353,7 +1967,9 @@ class ShellAsyncTerminal:
         else:
             self.history.append(command)
         self.historyind = -1
-        if command.startswith("cd"):
+        if command != "exit" and vim.eval("g:shellasync_terminal_persistent") == '1':
+            self.executeFramed(command)
+        elif command.startswith("cd"):
             if command == "cd":
                 command = "cd ~"
             if len(command.split(" ")) == 2 and not ('&' in command or ';' in command):
@@ -368,7 +1984,7 @@ class ShellAsyncTerminal:
                     self.cwd = pwd[-2]
                 self.commandFinished()
             else:
-                self.pid = ShellAsyncExecuteCmd(False,self.env)
+                self.executeCmd()
         elif command.startswith("setenv") or command.startswith("export"):
             command = command[7:]
             i = 0
@@ -432,7 +2048,48 @@ class ShellAsyncTerminal:
         elif command == "exit":
             vim.command(":bd!")
         else:
-            self.pid = ShellAsyncExecuteCmd(False,self.env)
+            self.executeCmd()
+
+    def executeCmd(self):
+        self.pid = ShellAsyncExecuteCmd(False,self.env)
+        if self.pid == None:
+            self.commandFinished()
+
+    def executeFramed(self,command):
+        # writes command to shell kept running between commands so it keeps its state,
+        # like working directory, variables, aliases and functions, and doesn't fork a new one
+        global shellasync_cmds
+        if self.shell == None or not self.shell in shellasync_cmds or not shellasync_cmds[self.shell].isAlive():
+            if self.shell in shellasync_cmds:
+                # previous shell exited and its output is shown, it's dropped quietly
+                # instead of being terminated and deleted as command of this buffer
+                ShellAsyncRefreshOutput()
+                shellasync_detached.discard(self.shell)
+                shellasync_cmds.pop(self.shell).close()
+                vim.eval("setbufvar('%','pid','')")
+            self.shell = ShellAsyncExecuteCmd(False,self.env,'++nopty /bin/sh',self.cwd)
+            if self.shell == None:
+                self.commandFinished()
+                return
+            # shell survives interrupting the command it runs, commands still get default SIGINT handler
+            shellasync_cmds[self.shell].writeQuiet("trap : INT\n")
+        self.pid = self.shell
+        vim.eval("setbufvar('%','pid',"+str(self.pid)+")")
+        shellasync_cmds[self.shell].writeFramed(command,self.token)
+        vim.command("call shellasync#StartRefresh()")
+
+    def interrupt(self):
+        # interrupts command running in persistent shell keeping the shell, terminates it otherwise
+        global shellasync_cmds
+        if self.pid == None:
+            return
+        if self.pid == self.shell and self.pid in shellasync_cmds and shellasync_cmds[self.pid].isAlive():
+            try:
+                os.killpg(self.pid,signal.SIGINT)
+            except OSError:
+                pass
+        else:
+            ShellAsyncTermCmd(self.pid)
 
     def commandAppend(self,line):
         vim.current.buffer.append(line)
@@ -447,37 +2104,175 @@ class ShellAsyncTerminal:
         vim.command("call shellasync#RefreshShellTerminal()")
         vim.command("startinsert")
 
-def ShellAsyncRefreshOutputFetch(output):
-    switchbackint = 0
+def ShellAsyncBufVarInt(name):
+    val = vim.eval("getbufvar('%','"+name+"')")
+    if val == None or val == '':
+        return 0
+    return int(val)
+
+def ShellAsyncCursorToEnd():
+    # same as normal! G0 but safe to use from timers and win_execute in any mode
+    vim.current.window.cursor = (len(vim.current.buffer), 0)
+
+def ShellAsyncTrimBuffer(dropped):
+    # trim current buffer from the top to its scrollback limit and update dropped lines counter
+    scrollback = ShellAsyncBufVarInt('scrollback')
+    scrollbackbytes = ShellAsyncBufVarInt('scrollbackbytes')
+    if scrollback <= 0 and scrollbackbytes <= 0 and dropped == 0:
+        return
+    b = vim.current.buffer
+    total = ShellAsyncBufVarInt('dropped')
+    header = 1 if total > 0 else 0
+    remove = 0
+    if scrollback > 0 and len(b)-header > scrollback:
+        remove = len(b)-header-scrollback
+    if scrollbackbytes > 0:
+        size = int(vim.eval("line2byte(line('$')+1)"))-1
+        if size > scrollbackbytes:
+            remove = max(remove, int(vim.eval("byte2line("+str(size-scrollbackbytes)+")"))-header)
+    remove = min(remove, len(b)-header-1)
+    if remove <= 0 and dropped == 0:
+        return
+    if remove > 0:
+        del b[header:header+remove]
+    total += remove + dropped
+    if ShellAsyncBufVarInt('spool') == 1:
+        line = "[shellasync: "+str(total)+" lines above, use :ShellPage to view them]"
+    else:
+        line = "[shellasync: "+str(total)+" lines dropped]"
+    if header:
+        b[0] = line
+    else:
+        b.append(line, 0)
+        remove -= 1
+    vim.command("let b:dropped = "+str(total))
+    pl = ShellAsyncBufVarInt('pl')
+    if pl > 0 and remove != 0:
+        vim.command("let b:pl = "+str(max(1, pl-remove)))
+    ShellAsyncCursorToEnd()
+
+def ShellAsyncAnsiColor(color):
+    # returns (cterm color, gui color) of 256 color index or rrggbb hex string
+    if isinstance(color, str):
+        rgb = [int(color[i:i+2], 16) for i in (0, 2, 4)]
+        if rgb[0] == rgb[1] == rgb[2] and rgb[0] > 3 and rgb[0] < 247:
+            cterm = 232+min(23, (rgb[0]-3)//10)
+        else:
+            cterm = 16+36*((rgb[0]+25)//51)+6*((rgb[1]+25)//51)+(rgb[2]+25)//51
+        return (cterm, '#'+color)
+    if color < 16:
+        return (color, shellasync_ansi_palette[color])
+    if color < 232:
+        levels = [0, 95, 135, 175, 215, 255]
+        color -= 16
+        return (color+16, '#%02x%02x%02x' % (levels[color//36], levels[(color//6)%6], levels[color%6]))
+    level = 8+(color-232)*10
+    return (color, '#%02x%02x%02x' % (level, level, level))
+
+def ShellAsyncAnsiHighlight(group):
+    # defines highlight group and text property type of a color style
+    global shellasync_ansi_defined, shellasync_ansi_mode
+    fg, bg, attributes = shellasync_ansi_styles[group]
+    colors = vim.eval("&t_Co")
+    colors = int(colors) if colors != None and colors != '' else 256
+    hi = "highlight "+group
+    if fg != None:
+        cterm, gui = ShellAsyncAnsiColor(fg)
+        if cterm < colors:
+            hi += " ctermfg="+str(cterm)
+        hi += " guifg="+gui
+    if bg != None:
+        cterm, gui = ShellAsyncAnsiColor(bg)
+        if cterm < colors:
+            hi += " ctermbg="+str(cterm)
+        hi += " guibg="+gui
+    if attributes != '':
+        attributes = ','.join([shellasync_ansi_attributes[a] for a in attributes])
+        hi += " cterm="+attributes+" gui="+attributes
+    vim.command(hi)
+    if not group in shellasync_ansi_defined:
+        shellasync_ansi_defined.add(group)
+        if shellasync_ansi_mode > 0:
+            vim.command("if empty(prop_type_get('"+group+"')) | call prop_type_add('"+group+"', {'highlight': '"+group+"'}) | endif")
+
+def ShellAsyncAnsiReset():
+    # called after colorscheme is changed since it clears highlight groups
+    for group in shellasync_ansi_defined:
+        ShellAsyncAnsiHighlight(group)
+
+def ShellAsyncAnsiApply(lnum,lines):
+    # highlights colored lines appended to current buffer starting at line lnum using
+    # text properties or matchaddpos if vim doesn't support them
+    global shellasync_ansi_mode
+    positions = {}
+    for i in range(len(lines)):
+        spans = getattr(lines[i], 'spans', None)
+        if spans != None:
+            for col, length, group in spans:
+                if not group in positions:
+                    positions[group] = []
+                positions[group].append([lnum+i, col, length])
+    if len(positions) == 0:
+        return
+    if shellasync_ansi_mode == None:
+        shellasync_ansi_mode = int(vim.eval("exists('*prop_add_list') ? 2 : has('textprop') ? 1 : 0"))
+    for group in positions:
+        if not group in shellasync_ansi_defined:
+            ShellAsyncAnsiHighlight(group)
+        pos = positions[group]
+        if shellasync_ansi_mode == 2:
+            vim.command("call prop_add_list({'type': '"+group+"'}, "+str([[l, c, l, c+n] for l, c, n in pos])+")")
+        elif shellasync_ansi_mode == 1:
+            for l, c, n in pos:
+                vim.command("call prop_add("+str(l)+", "+str(c)+", {'length': "+str(n)+", 'type': '"+group+"'})")
+        else:
+            for i in range(0, len(pos), 8):
+                vim.command("call matchaddpos('"+group+"', "+str(pos[i:i+8])+")")
+
+def ShellAsyncRefreshOutputFetch(output,focused=True):
+    # append output to current buffer in as few appends as possible, stops when
+    # g:shellasync_refresh_budget milliseconds are spent and leaves the rest for next refresh
+    budget = float(vim.eval("g:shellasync_refresh_budget"))/1000.0
+    start = time.time()
+    dropped = 0
+    maxlines = 1024
+    moved = False
+    # last line of buffer shows unterminated line of output which is replaced until it's complete
+    remshown = ShellAsyncBufVarInt('remshown') == 1
     while True:
-        out = output.get()
+        out = output.get(maxlines)
         if out != None:
             rem = out[0]
             remc = out[1]
+            dropped += out[3]
             out = out[2]
             if rem:
-                remc = remc and len(vim.current.buffer) != 1
-                if remc:
-                    vim.current.buffer.append(out)
-                    vim.command("normal! G0")
-                switchbackwnr = vim.eval("getbufvar('%','switchbackwnr')")
-                if switchbackwnr != None and switchbackwnr != '':
-                    if switchbackint > 9:
-                        if output.isWaitingForInput():
-                            vim.command("unlet! b:switchbackwnr")
-                            vim.command(str(switchbackwnr)+"wincmd w")
-                            break
-                    else:
-                        time.sleep(0.001)
-                        switchbackint += 1
-                        continue
-                if remc and int(vim.eval("&filetype == 'shellasyncterm'")) == 1:
+                b = vim.current.buffer
+                remc = remc and len(b) != 1
+                if len(b) == 1 and len(b[0]) == 0:
+                    b[0] = out[0]
+                    remshown = True
+                elif remc or not remshown:
+                    b.append(out)
+                    remshown = True
+                    moved = True
+                elif b[-1] != out[0]:
+                    b[-1] = out[0]
+                if focused and ShellAsyncSwitchBack(output,moved):
+                    moved = False
+                    break
+                if focused and remc and int(vim.eval("&filetype == 'shellasyncterm'")) == 1:
+                    ShellAsyncCursorToEnd()
+                    moved = False
                     vim.command("startinsert")
                 break
             else:
-                if remc and len(vim.current.buffer) > 1:
-                    if out[0].rstrip().find(vim.current.buffer[-1].rstrip()) == 0:
-                        vim.current.buffer[-1] = None
+                appendstart = time.time()
+                batch = out
+                if remshown:
+                    # first line completes the one shown as remainder
+                    vim.current.buffer[-1] = None
+                    remshown = False
                 if len(vim.current.buffer) == 1 and len(vim.current.buffer[0]) == 0:
                     vim.current.buffer[0] = out[0]
                     out = out[1:]
@@ -485,13 +2280,43 @@ def ShellAsyncRefreshOutputFetch(output):
                         vim.current.buffer.append(out)
                 else:
                     vim.current.buffer.append(out)
-                vim.command("normal! G0")
-                time.sleep(0.001)
-                switchbackint = 0
+                if output.ansi.colored:
+                    ShellAsyncAnsiApply(len(vim.current.buffer)-len(batch)+1, batch)
+                moved = True
+                now = time.time()
+                if shellasync_trace != None:
+                    shellasync_trace.add('buffer append', appendstart, {'pid': output.processPid, 'lines': len(batch)})
+                if now-start >= budget:
+                    break
+                # size next batch to what fits into remaining budget at the rate of this append
+                perline = max(now-appendstart, 0.000001)/max(len(out), 1)
+                maxlines = max(64, int((budget-(now-start))/perline))
         else:
+            # command may have started waiting for input after its prompt was shown
+            if focused and ShellAsyncSwitchBack(output,moved):
+                moved = False
             break
+    if moved:
+        ShellAsyncCursorToEnd()
+    if remshown != (ShellAsyncBufVarInt('remshown') == 1):
+        vim.command("let b:remshown = "+str(int(remshown)))
+    ShellAsyncTrimBuffer(dropped)
+    output.stats.ticks += 1
+    output.stats.fetchtime += time.time()-start
+
+def ShellAsyncSwitchBack(output,moved):
+    # returns to window input was sent from once command waits for input again, checked
+    # on every refresh instead of waiting for it so vim's thread is never put to sleep
+    switchbackwnr = vim.eval("getbufvar('%','switchbackwnr')")
+    if switchbackwnr == None or switchbackwnr == '' or not output.isWaitingForInput():
+        return False
+    if moved:
+        ShellAsyncCursorToEnd()
+    vim.command("unlet! b:switchbackwnr")
+    vim.command(str(switchbackwnr)+"wincmd w")
+    return True
 
-def ShellAsyncRefreshOutput():
+def ShellAsyncRefreshOutput(focused=True):
     global shellasync_cmds
     pid = vim.eval("getbufvar('%','pid')")
     if pid == None or pid == '':
@@ -500,8 +2325,98 @@ def ShellAsyncRefreshOutput():
     if pid in shellasync_cmds:
         output = shellasync_cmds[pid]
         if output != None:
-            ShellAsyncRefreshOutputFetch(output)
-    vim.command("call feedkeys(\"f\e\",'n')")
+            output.lastused = time.time()
+            if ShellAsyncBufVarInt('spoolfirst') > 0:
+                # buffer shows an older page of the spool, output will be loaded from spool
+                output.spoolSnapshot()
+            else:
+                ShellAsyncRefreshOutputFetch(output,focused)
+
+def ShellAsyncSpoolPage(line):
+    # show page of spooled output around line, or last page and follow output if line is 0
+    # or the page around it reaches the end of output
+    global shellasync_cmds
+    pid = ShellAsyncBufVarInt('pid')
+    if not pid in shellasync_cmds or shellasync_cmds[pid].spool == None:
+        ShellAsyncEchoMessage("output of this buffer isn't spooled")
+        return
+    output = shellasync_cmds[pid]
+    spool = output.spool
+    window = max(1, ShellAsyncBufVarInt('scrollback'))
+    b = vim.current.buffer
+    total = len(spool)
+    if line > 0:
+        line = min(line, total)
+        first = max(0, min(line-1-window//2, total-window))
+    if line <= 0 or first+window >= total:
+        total = output.spoolSnapshot()
+        first = max(0, total-window)
+        lines = spool.lines(first, total)
+        if first > 0:
+            lines.insert(0, "[shellasync: "+str(first)+" lines above, use :ShellPage to view them]")
+        if len(lines) == 0:
+            lines = ['']
+        b[:] = lines
+        vim.command("let b:dropped = "+str(first))
+        vim.command("let b:spoolfirst = 0")
+        vim.command("let b:remshown = 0")
+        if line <= 0:
+            ShellAsyncCursorToEnd()
+        else:
+            vim.current.window.cursor = (min(line-first+int(first > 0), len(b)), 0)
+    else:
+        lines = spool.lines(first, first+window)
+        b[:] = ["[shellasync: lines "+str(first+1)+"-"+str(first+len(lines))+" of "+str(total)+", use :ShellPage without arguments to follow output]"] + lines
+        vim.command("let b:spoolfirst = "+str(first+1))
+        vim.current.window.cursor = (line-first+1, 0)
+
+def ShellAsyncSpoolLine(row):
+    # spooled line shown at buffer row, first row of buffer is a header unless
+    # it shows the first spooled line
+    first = ShellAsyncBufVarInt('spoolfirst')
+    dropped = ShellAsyncBufVarInt('dropped')
+    if first > 0:
+        return first-1 + row-2
+    elif dropped > 0:
+        return dropped + row-2
+    return row-1
+
+def ShellAsyncSpoolScroll():
+    # page in output above or below when cursor reaches first or last line of
+    # spooled buffer keeping cursor on the same line of output
+    global shellasync_cmds
+    pid = ShellAsyncBufVarInt('pid')
+    if not pid in shellasync_cmds or shellasync_cmds[pid].spool == None:
+        return
+    row = vim.current.window.cursor[0]
+    line = ShellAsyncSpoolLine(row)
+    paged = ShellAsyncBufVarInt('spoolfirst') > 0
+    if row == 1 and line >= 0 and (paged or ShellAsyncBufVarInt('dropped') > 0):
+        ShellAsyncSpoolPage(line+1)
+    elif row == len(vim.current.buffer) and paged and line+1 < len(shellasync_cmds[pid].spool):
+        ShellAsyncSpoolPage(line+2)
+
+def ShellAsyncSpoolSearch(pattern,backward=False):
+    global shellasync_cmds
+    pid = ShellAsyncBufVarInt('pid')
+    if not pid in shellasync_cmds or shellasync_cmds[pid].spool == None:
+        ShellAsyncEchoMessage("output of this buffer isn't spooled")
+        return
+    spool = shellasync_cmds[pid].spool
+    line = ShellAsyncSpoolLine(vim.current.window.cursor[0])
+    try:
+        if backward:
+            found = spool.search(pattern, max(line, 0), True)
+        else:
+            found = spool.search(pattern, line+1)
+    except re.error as e:
+        ShellAsyncEchoMessage("invalid pattern: "+str(e))
+        return
+    if found == None:
+        ShellAsyncEchoMessage("pattern not found: "+pattern)
+        return
+    ShellAsyncSpoolPage(found[0]+1)
+    vim.current.window.cursor = (vim.current.window.cursor[0], found[1])
 
 def ShellAsyncRefreshOutputI():
     global shellasync_cmds
@@ -525,7 +2440,7 @@ def ShellAsyncRefreshOutputI():
         vim.command("call feedkeys(\"\ei\",'n')")
 
 
-def ShellAsyncTerminalRefreshOutput():
+def ShellAsyncTerminalRefreshOutput(focused=True):
     global shellasync_cmds
     cfinished = vim.eval("getbufvar('%','cfinished')")
     if cfinished == None or cfinished == '':
@@ -533,24 +2448,35 @@ def ShellAsyncTerminalRefreshOutput():
     cfinished = int(cfinished)
     if cfinished == 1:
         return
-    ShellAsyncRefreshOutput()
+    ShellAsyncRefreshOutput(focused)
     pid = vim.eval("getbufvar('%','pid')")
     if pid == None or pid == '':
         return
     pid = int(pid)
     if pid in shellasync_cmds:
         output = shellasync_cmds[pid]
-        if output.returnValue() != None and not output.hasdata():
+        framed = output.framestatus != None and output.isAlive()
+        if (output.returnValue() != None or framed) and not output.hasdata():
+            if framed:
+                # shell is idle until next command is written
+                output.sentinel = None
+                term = ShellAsyncBufVarInt('termnr')
+                if term in shellasync_terms:
+                    shellasync_terms[term].cwd = output.framestatus[1]
+                if vim.eval("g:shellasync_print_return_value") == '1':
+                    vim.current.buffer.append("Shell command completed with exit status "+str(output.framestatus[0]))
             vim.current.buffer.append("")
             vim.eval("setbufvar('%','cfinished',1)")
             vim.eval("setbufvar('%','pl',"+str(len(vim.current.buffer))+")")
             vim.command("call shellasync#RefreshShellTerminal()")
-            vim.command("call feedkeys(\"i\")")
+            if focused:
+                vim.command("startinsert")
     else:
         vim.eval("setbufvar('%','cfinished',1)")
         vim.eval("setbufvar('%','pl',"+str(len(vim.current.buffer))+")")
         vim.command("call shellasync#RefreshShellTerminal()")
-        vim.command("call feedkeys(\"i\")")
+        if focused:
+            vim.command("startinsert")
 
 def ShellAsyncTerminalRefreshOutputI():
     global shellasync_cmds
@@ -562,11 +2488,66 @@ def ShellAsyncTerminalRefreshOutputI():
         return
     ShellAsyncRefreshOutputI()
 
-def ShellAsyncExecuteCmd(clear,enviroment):
+def ShellAsyncCommandOptions(cmd):
+    # strips leading ++option words from command, returns command and dictionary of options
+    options = {}
+    while cmd.startswith('++'):
+        word = cmd.split(None, 1)
+        options[word[0][2:]] = True
+        cmd = word[1] if len(word) > 1 else ''
+    return (cmd, options)
+
+def ShellAsyncEncodingOptions():
+    # g:shellasync_encoding and g:shellasync_encoding_errors checked before they get to
+    # reactor thread, 'strict' would fail on first undecodable byte so it's replaced too
+    encoding = vim.eval("g:shellasync_encoding")
+    errors = vim.eval("g:shellasync_encoding_errors")
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        ShellAsyncEchoMessage("unknown g:shellasync_encoding "+encoding+", using utf-8")
+        encoding = 'utf-8'
+    try:
+        codecs.lookup_error(errors)
+    except LookupError:
+        ShellAsyncEchoMessage("unknown g:shellasync_encoding_errors "+errors+", using replace")
+        errors = 'replace'
+    if errors == 'strict':
+        errors = 'replace'
+    return (encoding, errors)
+
+def ShellAsyncExecuteCmd(clear,enviroment,command=None,cwd=None):
+    # command and cwd are read from variables of calling vim function unless given
     global shellasync_cmds
     print_retval = vim.eval("g:shellasync_print_return_value") == '1'
-    cmd = vim.eval("command")
-    cwd = vim.eval("cwd")
+    encoding, errors = ShellAsyncEncodingOptions()
+    scrollback = ShellAsyncBufVarInt('scrollback')
+    scrollbackbytes = ShellAsyncBufVarInt('scrollbackbytes')
+    spool = ShellAsyncBufVarInt('spool') == 1
+    usepty = vim.eval("g:shellasync_pty") == '1'
+    if command == None:
+        command = vim.eval("command")
+    cmd, options = ShellAsyncCommandOptions(command)
+    if 'spool' in options or 'nospool' in options:
+        spool = 'spool' in options
+        if spool:
+            scrollback = int(vim.eval("g:shellasync_spool_window"))
+        else:
+            scrollback = int(vim.eval("g:shellasync_scrollback_lines"))
+        vim.command("let b:spool = "+str(int(spool)))
+        vim.command("let b:scrollback = "+str(scrollback))
+    if spool:
+        vim.command("call shellasync#SpoolView()")
+    direct = vim.eval("g:shellasync_direct_exec") == '1' and not 'shell' in options
+    colors = vim.eval("g:shellasync_ansi_colors") == '1'
+    if 'pty' in options or 'nopty' in options:
+        usepty = 'pty' in options
+    pty = None
+    if usepty:
+        size = vim.eval("g:shellasync_pty_size")
+        pty = (int(size[0]), int(size[1]), vim.eval("g:shellasync_pty_term"))
+    if cwd == None:
+        cwd = vim.eval("cwd")
     pid = vim.eval("getbufvar('%','pid')")
     if pid != None and pid != '':
         pid = int(pid)
@@ -575,12 +2556,23 @@ def ShellAsyncExecuteCmd(clear,enviroment):
         ShellAsyncDeleteCmd(pid)
     if clear:
         vim.current.buffer[:] = None
+        vim.command("let b:dropped = 0")
+        vim.command("let b:spoolfirst = 0")
+        vim.command("let b:remshown = 0")
         vim.command("silent! refresh!")
     out = ShellAsyncOutput()
-    pid = out.startProcess(cmd,cwd,enviroment,print_retval)
+    pid = out.startProcess(cmd,cwd,enviroment,print_retval,encoding,errors,scrollback,scrollbackbytes,spool,pty,direct,colors)
     if pid != None:
         vim.eval("setbufvar('%','pid',"+str(pid)+")")
         shellasync_cmds[pid] = out
+        shellasync_evicted.pop(pid, None)
+        ShellAsyncEvictCmds()
+        vim.command("call shellasync#StartRefresh()")
+    else:
+        vim.eval("setbufvar('%','pid','')")
+        message = "Shell command "+cmd+" failed to start: "+out.spawnError()
+        vim.current.buffer.append(message)
+        ShellAsyncEchoMessage(message)
     return pid
 
 def ShellAsyncEchoMessage(message):
@@ -588,22 +2580,17 @@ def ShellAsyncEchoMessage(message):
     vim.command("echomsg \""+message+"\"")
 
 def ShellAsyncTermCmd(pid):
+    # doesn't wait for the process to exit, reactor thread kills it if it's still running
+    # after g:shellasync_terminate_timeout and outcome is reported once it exits
     global shellasync_cmds
     if pid in shellasync_cmds:
         out = shellasync_cmds[pid]
         if not out.isAlive():
             ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is finished")
             return True
-        try:
-            os.killpg(pid,signal.SIGTERM)
-        except OSError:
-            os.kill(pid,signal.SIGTERM)
-        out.join(15.0)
-        if out.isAlive():
-            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is still running")
-            return False
-        else:
-            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" terminated")
+        grace = int(vim.eval("g:shellasync_terminate_timeout"))
+        out.stop(signal.SIGTERM,grace/1000.0)
+        ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" terminating")
     return True
 
 def ShellAsyncKillCmd(pid):
@@ -613,16 +2600,8 @@ def ShellAsyncKillCmd(pid):
         if not out.isAlive():
             ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is finished")
             return True
-        try:
-            os.killpg(pid,signal.SIGKILL)
-        except OSError:
-            os.kill(pid,signal.SIGKILL)
-        out.join(15.0)
-        if out.isAlive():
-            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is still running")
-            return False
-        else:
-            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" killed")
+        out.stop(signal.SIGKILL)
+        ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" killing")
     return True
 
 def ShellAsyncDeleteCmd(pid):
@@ -631,13 +2610,129 @@ def ShellAsyncDeleteCmd(pid):
         out = shellasync_cmds[pid]
         if not out.isAlive():
             shellasync_cmds.pop(pid)
+            shellasync_detached.discard(pid)
+            out.close()
             ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" deleted")
             return True
+        elif out.isStopping():
+            # deleted once it exits instead of waiting for it
+            shellasync_detached.add(pid)
+            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is deleted once it exits")
+            return True
         else:
             ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" is still running")
             return False
+    elif pid in shellasync_evicted:
+        summary = shellasync_evicted.pop(pid)
+        ShellAsyncEchoMessage("shell command "+summary.command+" pid: "+str(pid)+" deleted")
     return True
 
+def ShellAsyncCloseCmd(pid,bnr):
+    # buffer bnr showing command is wiped out, running command is terminated and deleted
+    # while output of finished one is kept to be reopened by ShellAsyncOpenCmd
+    global shellasync_cmds
+    if not pid in shellasync_cmds:
+        return
+    out = shellasync_cmds[pid]
+    if out.isAlive():
+        ShellAsyncTermCmd(pid)
+        ShellAsyncDeleteCmd(pid)
+    elif out.spool == None:
+        out.retain(vim.buffers[bnr][:])
+
+def ShellAsyncOpenableCmd(pid):
+    # command of pid if its output can be opened in a new buffer, empty string otherwise
+    global shellasync_cmds
+    if pid in shellasync_evicted:
+        ShellAsyncEchoMessage("output of shell command "+shellasync_evicted[pid].command+" pid: "+str(pid)+" is no longer available")
+        return ''
+    if not pid in shellasync_cmds:
+        ShellAsyncEchoMessage("no shell command with pid: "+str(pid))
+        return ''
+    return shellasync_cmds[pid].processCommand()
+
+def ShellAsyncOpenCmd(pid):
+    # shows output of command in current buffer, spooled output is paged in from spool
+    global shellasync_cmds
+    out = shellasync_cmds[pid]
+    out.lastused = time.time()
+    vim.command("let b:pid = "+str(pid))
+    if out.spool != None:
+        vim.command("let b:spool = 1")
+        vim.command("let b:scrollback = g:shellasync_spool_window")
+        vim.command("call shellasync#SpoolView()")
+        ShellAsyncSpoolPage(0)
+        return
+    if out.archive != None:
+        lines = out.restore()
+        if len(lines) > 0:
+            vim.current.buffer[:] = lines
+    ShellAsyncRefreshOutput()
+    ShellAsyncCursorToEnd()
+
+def ShellAsyncReapCmds():
+    # reports outcome of terminated processes and deletes the ones whose deletion was requested while they were stopping
+    global shellasync_cmds
+    for pid in list(shellasync_cmds.keys()):
+        out = shellasync_cmds[pid]
+        if not out.stoprequested or out.stopreported or out.isAlive():
+            continue
+        out.stopreported = True
+        if pid in shellasync_detached:
+            shellasync_cmds.pop(pid)
+            shellasync_detached.discard(pid)
+            out.close()
+        else:
+            ShellAsyncEchoMessage("shell command "+out.processCommand()+" pid: "+str(pid)+" "+out.stopOutcome())
+    ShellAsyncEvictCmds()
+
+def ShellAsyncVisiblePids():
+    pids = set()
+    for w in vim.windows:
+        pid = vim.eval("getbufvar("+str(w.buffer.number)+",'pid')")
+        if pid != None and pid != '':
+            pids.add(int(pid))
+    return pids
+
+def ShellAsyncEvictCmds():
+    # finished commands are kept until there are more than g:shellasync_keep_finished of them, their
+    # output takes more than g:shellasync_keep_finished_bytes or they weren't used for
+    # g:shellasync_keep_finished_seconds, least recently used ones are evicted first and only their
+    # summary is kept, commands shown in a window count as used
+    global shellasync_cmds
+    maxcount = int(vim.eval("g:shellasync_keep_finished"))
+    maxbytes = int(vim.eval("g:shellasync_keep_finished_bytes"))
+    maxage = int(vim.eval("g:shellasync_keep_finished_seconds"))
+    if maxcount <= 0 and maxbytes <= 0 and maxage <= 0:
+        return
+    now = time.time()
+    visible = ShellAsyncVisiblePids()
+    finished = []
+    total = 0
+    for pid in shellasync_cmds.keys():
+        out = shellasync_cmds[pid]
+        if out.isAlive() or pid in shellasync_detached:
+            continue
+        if pid in visible:
+            out.lastused = now
+        finished.append((max(out.lastused, out.stats.exited or 0), pid))
+        if maxbytes > 0:
+            total += out.retained()
+    finished.sort()
+    count = len(finished)
+    for used, pid in finished:
+        if not ((maxcount > 0 and count > maxcount) or (maxbytes > 0 and total > maxbytes) or (maxage > 0 and now-used > maxage)):
+            continue
+        out = shellasync_cmds.pop(pid)
+        if maxbytes > 0:
+            total -= out.retained()
+        count -= 1
+        out.close()
+        shellasync_evicted[pid] = ShellAsyncSummary(out)
+    # summaries are bounded too, oldest are forgotten
+    while len(shellasync_evicted) > (maxcount if maxcount > 0 else 100):
+        shellasync_evicted.popitem(False)
+
 def ShellAsyncShellRunning(pid):
     global shellasync_cmds
     if pid in shellasync_cmds:
@@ -661,10 +2756,18 @@ def ShellAsyncSendCmd(pid,nl):
     return False
 
 def ShellAsyncTermAllCmds():
+    # every process is terminated at once and killed by reactor thread if it's still running after
+    # g:shellasync_shutdown_timeout, waiting for all of them against the same deadline keeps quitting
+    # vim from taking longer the more processes are running
     global shellasync_cmds
-    for pid in list(shellasync_cmds.keys()):
-        if not ShellAsyncTermCmd(pid):
-            ShellAsyncKillCmd(pid)
+    timeout = int(vim.eval("g:shellasync_shutdown_timeout"))/1000.0
+    running = [out for out in shellasync_cmds.values() if out.isAlive()]
+    for out in running:
+        out.stop(signal.SIGTERM,timeout)
+    # killed processes get a moment to be reaped so they aren't left behind when vim exits
+    deadline = time.time()+timeout+0.5
+    for out in running:
+        out.join(max(0.0, deadline-time.time()))
 
 def ShellAsyncRunningCmds():
     global shellasync_cmds
@@ -677,42 +2780,228 @@ def ShellAsyncRunningCmds():
 
 def ShellAsyncListShells():
     global shellasync_cmds
+    trace = shellasync_trace
+    if trace != None:
+        start = time.time()
+    ShellAsyncReapCmds()
     pos = vim.eval("getpos('.')")
     selectbnr = vim.eval("getbufvar('%','selectbnr')")
     vim.current.buffer[:] = None
-    title='shellasync - list of running processes (press t to terminate, K to kill, d to delete, s to send input' 
+    title='shellasync - list of running processes (press t to terminate, K to kill, d to delete, s to send input, o to open' 
     if selectbnr != None and selectbnr != '':
         vim.current.buffer[0]=title+', S to select shell)'
     else:
         vim.current.buffer[0]=title+')'
-    vim.current.buffer.append('<Status>  <Return>  <PID>    <Command>')
+    vim.current.buffer.append('<Status>  <Return>  <PID>    <Rate>    <First>  <Command>')
     i = 2
-    if len(shellasync_cmds) > 0:
-        for pid in shellasync_cmds.keys():
-            out = shellasync_cmds[pid]
-            if out.isAlive():
-                s="Running   "
-            else:
-                s="Finished  "
-            retval = out.returnValue()
-            if retval == None:
-                s += "   -      "
-            else:
-                retval = str(retval)
-                l = (8-len(retval))/2
-                retval = (" "*l)+retval+(" "*l)
-                if len(retval) < 10:
-                    retval += " "*(10-len(retval))
-                s += retval
-            pid = str(pid)
-            if len(pid) < 9:
-                pid += " "*(9-len(pid))
-            s += pid
-            s += out.processCommand()
-            vim.current.buffer.append(s)
-            i += 1
-    else:
+    for pid in shellasync_cmds.keys():
+        out = shellasync_cmds[pid]
+        done, total = out.inputProgress()
+        if out.isAlive() and done < total:
+            s="Send "+str(done*100//total)+"%"
+            s += " "*(10-len(s))
+        elif out.isStopping():
+            s="Stopping  "
+        elif out.isAlive():
+            s="Running   "
+        elif out.stopsignal == signal.SIGKILL:
+            s="Killed    "
+        elif out.stopsignal != None:
+            s="Terminated"
+        else:
+            s="Finished  "
+        rate, first = ShellAsyncListStats(out)
+        vim.current.buffer.append(ShellAsyncListRow(s,out.returnValue(),pid,rate,first,out.processCommand()))
+        i += 1
+    for pid in shellasync_evicted.keys():
+        summary = shellasync_evicted[pid]
+        rate = '-'
+        if summary.runtime > 0 and summary.bytesread > 0:
+            rate = ShellAsyncFormatSize(summary.bytesread/summary.runtime)+'/s'
+        vim.current.buffer.append(ShellAsyncListRow("Evicted   ",summary.retval,pid,rate,'-',summary.command+" (output no longer available)"))
+        i += 1
+    if i == 2:
         vim.current.buffer.append("--------No running processes----------")
     vim.eval("setpos('.',"+str(pos)+")")
-    vim.command("call feedkeys(\"f\e\")")
+    if trace != None:
+        trace.add('list rebuild', start, {'processes': len(shellasync_cmds)})
+
+def ShellAsyncListRow(status,retval,pid,rate,first,command):
+    s = status
+    if retval == None:
+        s += "   -      "
+    else:
+        retval = str(retval)
+        l = (8-len(retval))//2
+        retval = (" "*l)+retval+(" "*l)
+        if len(retval) < 10:
+            retval += " "*(10-len(retval))
+        s += retval
+    pid = str(pid)
+    if len(pid) < 9:
+        pid += " "*(9-len(pid))
+    s += pid
+    s += rate+" "*(10-len(rate))
+    s += first+" "*(9-len(first))
+    return s+command
+
+def ShellAsyncListState():
+    global shellasync_cmds
+    return list(shellasync_evicted.keys())+[(pid, shellasync_cmds[pid].isAlive(), shellasync_cmds[pid].stopsignal, shellasync_cmds[pid].returnValue(), shellasync_cmds[pid].inputProgress(), ShellAsyncListStats(shellasync_cmds[pid])) for pid in shellasync_cmds.keys()]
+
+def ShellAsyncListStats(out):
+    # output throughput and time to first byte of output as shown in list of shells
+    stats = out.stats
+    runtime = stats.runtime()
+    rate = '-'
+    if runtime > 0 and stats.bytesread > 0:
+        rate = ShellAsyncFormatSize(stats.bytesread/runtime)+'/s'
+    first = '-'
+    if stats.firstbyte != None:
+        first = ShellAsyncFormatTime(stats.firstbyte-stats.spawned)
+    return (rate, first)
+
+def ShellAsyncFormatSize(size):
+    for unit in ('B', 'K', 'M'):
+        if size < 1024:
+            return ('%d' if unit == 'B' else '%.1f') % size + unit
+        size /= 1024.0
+    return '%.1fG' % size
+
+def ShellAsyncFormatTime(seconds):
+    if seconds < 1:
+        return '%dms' % (seconds*1000)
+    return '%.1fs' % seconds
+
+def ShellAsyncTraceStart(size):
+    # starts tracing into a ring buffer of size events, stops tracing if size is 0
+    global shellasync_trace
+    size = int(size)
+    if size > 0:
+        shellasync_trace = ShellAsyncTrace(size)
+    else:
+        shellasync_trace = None
+
+def ShellAsyncTraceDump(path):
+    trace = shellasync_trace
+    if trace == None:
+        ShellAsyncEchoMessage("tracing isn't enabled, use :ShellTrace to enable it")
+        return
+    try:
+        f = open(os.path.expanduser(path), 'w')
+        try:
+            json.dump(trace.chrome(), f)
+        finally:
+            f.close()
+    except (IOError, OSError) as e:
+        ShellAsyncEchoMessage("couldn't write trace to "+path+": "+str(e))
+        return
+    ShellAsyncEchoMessage("wrote "+str(len(trace.events))+" trace events to "+path)
+
+def ShellAsyncStats(pid=None):
+    # statistics of command with pid or of all commands keyed by pid, see ShellAsyncOutput.statistics
+    global shellasync_cmds
+    if pid == None:
+        return dict([(str(p), shellasync_cmds[p].statistics()) for p in shellasync_cmds.keys()])
+    pid = int(pid)
+    if pid in shellasync_cmds:
+        return shellasync_cmds[pid].statistics()
+    return {}
+
+def ShellAsyncStatsCmd(pid):
+    global shellasync_cmds
+    if pid in shellasync_evicted:
+        summary = shellasync_evicted[pid]
+        ShellAsyncEchoMessage("shell command "+summary.command+" pid: "+str(pid)+" "+summary.outcome+", output evicted")
+        for key, value in (('exit_status', summary.retval), ('bytes_read', summary.bytesread), ('lines_read', summary.linesread),
+                           ('runtime_ms', round(summary.runtime*1000.0, 3))):
+            ShellAsyncEchoMessage("  "+key+": "+str(value))
+        return
+    if not pid in shellasync_cmds:
+        ShellAsyncEchoMessage("no shell command with pid: "+str(pid))
+        return
+    stats = shellasync_cmds[pid].statistics()
+    lines = ["shell command "+stats['command']+" pid: "+str(pid)+(" running" if stats['running'] else " finished")]
+    for key in ('bytes_read', 'lines_read', 'reads', 'bytes_written', 'first_byte_ms', 'exit_ms', 'runtime_ms', 'bytes_per_second',
+                'lines_per_second', 'lock_acquires', 'lock_contended', 'lock_wait_ms', 'refresh_ticks', 'fetch_ms'):
+        lines.append("  "+key+": "+str(stats[key]))
+    for line in lines:
+        ShellAsyncEchoMessage(line)
+
+def ShellAsyncRefreshWindows():
+    # called from refresh timer, refreshes every visible shellasync window whether it's focused or not
+    # returns delay in milliseconds until next refresh, 0 if nothing is running and everything is shown
+    # or the reactor thread wakes the timer up through ShellAsyncWakeup once there's anything to show
+    global shellasync_cmds, shellasync_liststate
+    interval = int(vim.eval("g:shellasync_update_interval"))
+    insert = vim.eval("mode()") in ('i', 'R')
+    winexecute = vim.eval("exists('*win_execute')") == '1'
+    current = vim.current.window
+    # armed before looking at output so changes from now on wake up the timer
+    wakeup = shellasync_wakeup
+    if wakeup != None:
+        wakeup.arm()
+    ShellAsyncReapCmds()
+    liststate = ShellAsyncListState()
+    listchanged = liststate != shellasync_liststate
+    shellasync_liststate = liststate
+    more = False
+    refreshed = False
+    for w in vim.windows:
+        if w != current and not winexecute:
+            continue
+        bnr = str(w.buffer.number)
+        filetype = vim.eval("getbufvar("+bnr+",'&filetype')")
+        if filetype == 'shellasynclist':
+            if not listchanged:
+                continue
+            refresh = 'ShellAsyncListShells'
+            args = ()
+        elif filetype == 'shellasync' or filetype == 'shellasyncterm':
+            pid = vim.eval("getbufvar("+bnr+",'pid')")
+            output = None
+            if pid != None and pid != '' and int(pid) in shellasync_cmds:
+                output = shellasync_cmds[int(pid)]
+            if filetype == 'shellasyncterm':
+                if vim.eval("getbufvar("+bnr+",'cfinished')") != '0':
+                    continue
+                # persistent shell stays alive, framed command is complete once its status is in
+                if output != None and output.isAlive() and not output.hasdata() and (output.sentinel == None or output.framestatus == None):
+                    continue
+                refresh = 'ShellAsyncTerminalRefreshOutput'
+            else:
+                if output == None:
+                    continue
+                # window input was sent from is switched back to once command waits for input
+                if not output.hasdata() and not (output.isWaitingForInput() and vim.eval("getbufvar("+bnr+",'switchbackwnr')") not in (None, '')):
+                    continue
+                refresh = 'ShellAsyncRefreshOutput'
+            if w == current and insert:
+                # output is fetched in normal mode on next refresh
+                vim.command("stopinsert")
+                more = True
+                continue
+            args = (w == current,)
+        else:
+            continue
+        if w == current:
+            globals()[refresh](*args)
+        else:
+            vim.command("call win_execute(win_getid("+str(w.number)+"), 'pythonx shellasync."+refresh+"("+",".join([str(a) for a in args])+")')")
+        refreshed = True
+        if filetype != 'shellasynclist' and output != None and output.hasdata():
+            more = True
+    if refreshed:
+        vim.command("redraw")
+    if more:
+        return 1
+    if wakeup != None and wakeup.ready():
+        # reactor thread restarts the timer once anything changes
+        return 0
+    for pid in shellasync_cmds.keys():
+        out = shellasync_cmds[pid]
+        # idle persistent shell of a terminal doesn't need refreshing
+        if out.isAlive() and (out.sentinel != None or out.framestatus == None or out.stoprequested):
+            return interval
+    return 0
 
@@ -76,6 +76,9 @@ del shellasync_path
 import shellasync
 EOF
 endif
+if g:shellasync_trace > 0
+    exe 'pythonx shellasync.ShellAsyncTraceStart('.g:shellasync_trace.')'
+endif
 " }}}
 
 " functions {{{
@@ -114,6 +117,15 @@ function! s:TermShellInBuf(del)
     endif
 endfunction
 
+function! s:CloseShellBuf()
+    " finished command's output is kept compressed so it can be reopened with ShellOpen
+    let bnr = str2nr(expand('<abuf>'))
+    let pid = getbufvar(bnr,'pid')
+    if pid != ''
+        exe 'pythonx shellasync.ShellAsyncCloseCmd('.pid.','.bnr.')'
+    endif
+endfunction
+
 function! s:SelectShell(pidlist)
     if len(a:pidlist) > 0
         let pid = a:pidlist[0]
@@ -159,6 +171,12 @@ function! s:SendShellInput(pid,input_data,nl)
     endif
 endfunction
 
+function! s:CursorHoldRefresh(refresh)
+    " used when vim has no timers, keeps CursorHold firing while the window is idle
+    exe 'pythonx shellasync.'.a:refresh.'()'
+    call feedkeys("f\e",'n')
+endfunction
+
 function! s:CmdShell(cmd, pidlist)
     if len(a:pidlist) == 0
         echo 'please specify a pid or associate a pid with current buffer using ShellSelect'
@@ -308,13 +326,15 @@ function! s:TerminalEnterPressed()
     elseif command =~ '^\s*clear\s*$' 
         silent! normal! gg"_dG
         call setbufvar('%','pl',1)
+        call setbufvar('%','dropped',0)
         call shellasync#RefreshShellTerminal()
         startinsert
     else
         let termnr = getbufvar('%','termnr')
         let pid = getbufvar('%','pid')
         let cwd = pyxeval('shellasync.shellasync_terms['.termnr.'].cwd')
-        if pid != ''
+        " persistent shell of this terminal is kept running between commands
+        if pid != '' && !pyxeval('int(shellasync.shellasync_terms['.termnr.'].shell == '.pid.')')
             silent! call shellasync#DeleteShell([pid])
         endif
         call setbufvar('%','cfinished',0)
@@ -336,6 +356,48 @@ endfunction
 " }}}
 
 " global functions {{{
+let s:refresh_timer = -1
+let s:wakeup_connected = -1
+
+function! s:Wakeup(...)
+    call shellasync#StartRefresh()
+endfunction
+
+function! s:ConnectWakeup()
+    " reactor thread wakes the refresh timer up through a channel once commands have new output,
+    " timer keeps polling running commands if the channel can't be opened
+    let s:wakeup_connected = 0
+    let address = '127.0.0.1:'.pyxeval('shellasync.ShellAsyncGetWakeup().port()')
+    try
+        if exists('*sockconnect')
+            call sockconnect('tcp', address, {'on_data': function('s:Wakeup')})
+            let s:wakeup_connected = 1
+        elseif exists('*ch_open')
+            let channel = ch_open(address, {'mode': 'raw', 'callback': function('s:Wakeup'), 'waittime': 1000})
+            let s:wakeup_connected = ch_status(channel) == 'open'
+        endif
+    catch
+    endtry
+    exe 'pythonx shellasync.ShellAsyncGetWakeup().accept('.s:wakeup_connected.')'
+endfunction
+
+function! shellasync#StartRefresh()
+    if has('timers') && s:refresh_timer == -1
+        if s:wakeup_connected == -1
+            call s:ConnectWakeup()
+        endif
+        let s:refresh_timer = timer_start(g:shellasync_update_interval, 'shellasync#Refresh')
+    endif
+endfunction
+
+function! shellasync#Refresh(timer)
+    let s:refresh_timer = -1
+    let interval = pyxeval('shellasync.ShellAsyncRefreshWindows()')
+    if interval > 0
+        let s:refresh_timer = timer_start(interval, 'shellasync#Refresh')
+    endif
+endfunction
+
 function! shellasync#ExecuteInShell(bang, samewin, command)
     if a:bang == '!'
         let command = s:ExpandCommand(a:command)
@@ -358,28 +420,42 @@ function! shellasync#ExecuteInShell(bang, samewin, command)
     endif
     
     if winnr < 0 || !a:samewin
-        execute &lines/3 . 'sp ' . fnameescape('shellasync '.shellnr.'- '.command)
-        setlocal buftype=nofile bufhidden=wipe buflisted noswapfile nowrap nonumber
-        setlocal filetype=shellasync
+        call s:OpenShellWindow('shellasync '.shellnr.'- '.command, command)
+        pythonx shellasync.ShellAsyncExecuteCmd(True,os.environ)
+    else
+        exe winnr . 'wincmd w'
+        pythonx shellasync.ShellAsyncExecuteCmd(True,os.environ)
+    endif
+endfunction
+
+function! s:OpenShellWindow(name, command)
+    execute &lines/3 . 'sp ' . fnameescape(a:name)
+    setlocal buftype=nofile bufhidden=wipe buflisted noswapfile nowrap nonumber
+    setlocal filetype=shellasync
+    call setbufvar("%","command",a:command)
+    call setbufvar("%","scrollback",g:shellasync_scrollback_lines)
+    call setbufvar("%","scrollbackbytes",g:shellasync_scrollback_bytes)
+    call setbufvar("%","spool",g:shellasync_spool)
+    if g:shellasync_spool
+        call setbufvar("%","scrollback",g:shellasync_spool_window)
+    endif
+    au BufWipeout <buffer> silent call <SID>CloseShellBuf()
+    if has('timers')
+        au BufEnter <buffer> call shellasync#StartRefresh()
+    else
         call setbufvar("%","prevupdatetime",&updatetime)
-        call setbufvar("%","command",command)
         exe 'set updatetime='.g:shellasync_update_interval
-        au BufWipeout <buffer> silent call <SID>TermShellInBuf(1)
         exe 'au BufEnter <buffer> set updatetime='.g:shellasync_update_interval
         au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
-        au CursorHold <buffer> pythonx shellasync.ShellAsyncRefreshOutput()
+        au CursorHold <buffer> call <SID>CursorHoldRefresh('ShellAsyncRefreshOutput')
         au CursorHoldI <buffer> pythonx shellasync.ShellAsyncRefreshOutputI()
-        nnoremap <buffer> <C-c> :echo '' \| call <SID>TermShellInBuf(0)<CR>
-        pythonx shellasync.ShellAsyncExecuteCmd(True,os.environ)
-    else
-        exe winnr . 'wincmd w'
-        pythonx shellasync.ShellAsyncExecuteCmd(True,os.environ)
     endif
+    nnoremap <buffer> <C-c> :echo '' \| call <SID>TermShellInBuf(0)<CR>
 endfunction
 
 function! shellasync#GetPidList(...)
     if &filetype == 'shellasynclist'
-        let words = split(getline('.'), '\s\+')
+        let words = split(substitute(getline('.'), '^Send \d\+%', 'Send', ''), '\s\+')
         if len(words) >= 4 && match(words[2],'\d\+') == 0
             let pid = words[2]
             return [pid]
@@ -409,6 +485,28 @@ function! shellasync#DeleteShell(pidlist)
     call s:CmdShell('ShellAsyncDeleteCmd',a:pidlist)
 endfunction
 
+function! shellasync#StatsShell(pidlist)
+    call s:CmdShell('ShellAsyncStatsCmd',a:pidlist)
+endfunction
+
+function! shellasync#OpenShell(pidlist)
+    if len(a:pidlist) == 0
+        echo 'please specify a pid'
+        return
+    endif
+    let pid = a:pidlist[0]
+    let wnr = s:ShellWindow(pid)
+    if wnr != -1
+        exe wnr.'wincmd w'
+        return
+    endif
+    let command = pyxeval('shellasync.ShellAsyncOpenableCmd('.pid.')')
+    if command != ''
+        call s:OpenShellWindow('shellasync - '.command.' ('.pid.')', command)
+        exe 'pythonx shellasync.ShellAsyncOpenCmd('.pid.')'
+    endif
+endfunction
+
 function! shellasync#SendShell(c,l1,l2,pidlist)
     if len(a:pidlist) == 0
         echo 'no pid specified and no shell associated with buffer, use ShellSelect to associate shell with this buffer'
@@ -426,6 +524,95 @@ function! shellasync#SendShell(c,l1,l2,pidlist)
     call s:SendShellInput(a:pidlist[0],send_input,1)
 endfunction
 
+function! shellasync#SpoolPage(...)
+    if len(a:000) > 0
+        let line = str2nr(a:1)
+    else
+        let line = 0
+    endif
+    exe 'pythonx shellasync.ShellAsyncSpoolPage('.line.')'
+endfunction
+
+function! shellasync#SpoolSearch(pattern,...)
+    let pattern = a:pattern
+    let backward = len(a:000) > 0 ? a:1 : 0
+    let b:spoolpattern = pattern
+    let b:spoolbackward = backward
+    exe 'pythonx shellasync.ShellAsyncSpoolSearch(vim.eval("pattern"),'.backward.')'
+endfunction
+
+function! shellasync#SpoolView()
+    " map motions and searches of spooled buffer to whole spooled output
+    if exists('b:spoolview')
+        return
+    endif
+    let b:spoolview = 1
+    nnoremap <buffer> <silent> gg :<C-u>call shellasync#SpoolGo(v:count,'gg')<CR>
+    nnoremap <buffer> <silent> G :<C-u>call shellasync#SpoolGo(v:count,'G')<CR>
+    nnoremap <buffer> / :<C-u>call shellasync#SpoolSearchPrompt(0)<CR>
+    nnoremap <buffer> ? :<C-u>call shellasync#SpoolSearchPrompt(1)<CR>
+    nnoremap <buffer> <silent> n :<C-u>call shellasync#SpoolSearchNext(0)<CR>
+    nnoremap <buffer> <silent> N :<C-u>call shellasync#SpoolSearchNext(1)<CR>
+    au CursorMoved <buffer> call shellasync#SpoolScroll()
+endfunction
+
+function! shellasync#SpoolGo(count,key)
+    if !getbufvar('%','spool')
+        exe 'normal! '.(a:count > 0 ? a:count : '').a:key
+    elseif a:key == 'G' && a:count == 0
+        call shellasync#SpoolPage()
+    else
+        call shellasync#SpoolPage(a:count > 0 ? a:count : 1)
+    endif
+endfunction
+
+function! shellasync#SpoolSearchPrompt(backward)
+    if !getbufvar('%','spool')
+        call feedkeys(a:backward ? '?' : '/','n')
+        return
+    endif
+    let pattern = input(a:backward ? '?' : '/')
+    if pattern == ''
+        let pattern = get(b:,'spoolpattern','')
+    endif
+    if pattern != ''
+        call shellasync#SpoolSearch(pattern,a:backward)
+    endif
+endfunction
+
+function! shellasync#SpoolSearchNext(reverse)
+    if !getbufvar('%','spool')
+        exe 'normal! '.(a:reverse ? 'N' : 'n')
+    elseif get(b:,'spoolpattern','') == ''
+        echo 'no previous pattern'
+    else
+        let backward = get(b:,'spoolbackward',0)
+        call shellasync#SpoolSearch(b:spoolpattern,a:reverse ? !backward : backward)
+        let b:spoolbackward = backward
+    endif
+endfunction
+
+function! shellasync#SpoolScroll()
+    if !getbufvar('%','spool')
+        return
+    endif
+    let paged = get(b:,'spoolfirst',0) > 0
+    if (line('.') == 1 && (get(b:,'spoolfirst',0) > 1 || (!paged && get(b:,'dropped',0) > 0))) || (line('.') == line('$') && paged)
+        pythonx shellasync.ShellAsyncSpoolScroll()
+    endif
+endfunction
+
+function! shellasync#Trace(...)
+    let size = len(a:000) > 0 ? str2nr(a:1) : 100000
+    exe 'pythonx shellasync.ShellAsyncTraceStart('.size.')'
+    echo size > 0 ? 'tracing last '.size.' events' : 'tracing stopped'
+endfunction
+
+function! shellasync#TraceDump(file)
+    let file = a:file
+    pythonx shellasync.ShellAsyncTraceDump(vim.eval('file'))
+endfunction
+
 function! shellasync#ShellSelect(...)
     let bnr = bufnr('%')
     if len(a:000) == 0
@@ -461,23 +648,29 @@ function! shellasync#OpenShellsList(selectbnr)
     if winnr < 0
         execute &lines/3 . 'sp ' . fnameescape(command)
         setlocal buftype=nofile bufhidden=wipe nolist nobuflisted noswapfile nowrap nonumber filetype=shellasynclist
-        call setbufvar("%","prevupdatetime",&updatetime)
         call setbufvar("%","command",command)
-        exe 'set updatetime='.g:shellasync_update_interval
-        exe 'au BufEnter <buffer> set updatetime='.g:shellasync_update_interval
-        au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
-        au CursorHold <buffer> pythonx shellasync.ShellAsyncListShells()
+        if has('timers')
+            au BufEnter <buffer> call shellasync#StartRefresh()
+        else
+            call setbufvar("%","prevupdatetime",&updatetime)
+            exe 'set updatetime='.g:shellasync_update_interval
+            exe 'au BufEnter <buffer> set updatetime='.g:shellasync_update_interval
+            au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime')
+            au CursorHold <buffer> call <SID>CursorHoldRefresh('ShellAsyncListShells')
+        endif
         nnoremap <silent> <buffer> t :call shellasync#TermShell(shellasync#GetPidList()) \| pythonx shellasync.ShellAsyncListShells()<CR>
         nnoremap <silent> <buffer> K :call shellasync#KillShell(shellasync#GetPidList()) \| pythonx shellasync.ShellAsyncListShells()<CR>
         nnoremap <silent> <buffer> d :call shellasync#DeleteShell(shellasync#GetPidList()) \| pythonx shellasync.ShellAsyncListShells()<CR>
         nnoremap <silent> <buffer> x :call shellasync#DeleteShell(shellasync#GetPidList()) \| pythonx shellasync.ShellAsyncListShells()<CR>
         nnoremap <silent> <buffer> s :call shellasync#SendShell(-1,0,0,shellasync#GetPidList()) \| pythonx shellasync.ShellAsyncListShells()<CR>
+        nnoremap <silent> <buffer> o :call shellasync#OpenShell(shellasync#GetPidList())<CR>
         if a:selectbnr > 0
             call setbufvar("%","selectbnr",a:selectbnr)
             call setbufvar("%","selectbnrlist",1)
             nnoremap <silent> <buffer> S :call <SID>SelectShell(shellasync#GetPidList())<CR>
         endif
         pythonx shellasync.ShellAsyncListShells()
+        call shellasync#StartRefresh()
     else
         exe winnr . 'wincmd w'
         if a:selectbnr > 0
@@ -499,18 +692,25 @@ function! shellasync#OpenShellTerminal()
     let termnr += 1
     execute 'belowright '.(&lines/3) . 'sp ' . fnameescape('shellasyncterm - '.termnr)
     setlocal buftype=nofile bufhidden=wipe buflisted nolist noswapfile nowrap nonumber filetype=shellasyncterm
-    call setbufvar("%","prevupdatetime",&updatetime)
     call setbufvar("%","termnr",termnr)
     call setbufvar("%","pl",1)
     call setbufvar("%","cfinished",1)
+    call setbufvar("%","scrollback",g:shellasync_scrollback_lines)
+    call setbufvar("%","scrollbackbytes",g:shellasync_scrollback_bytes)
     exe 'pythonx shellasync.shellasync_terms['.termnr.'] = shellasync.ShellAsyncTerminal()'
-    exe 'set updatetime='.g:shellasync_update_interval
     au BufWipeout <buffer> silent call <SID>CloseShellTerminal()
-    exe 'au BufEnter <buffer> set updatetime='.g:shellasync_update_interval.' | call <SID>TerminalBufEnter()'
-    au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime') | stopinsert
     au InsertEnter <buffer> call <SID>TerminalStartInsert()
-    au CursorHold <buffer> pythonx shellasync.ShellAsyncTerminalRefreshOutput()
-    au CursorHoldI <buffer> pythonx shellasync.ShellAsyncTerminalRefreshOutputI()
+    if has('timers')
+        au BufEnter <buffer> call shellasync#StartRefresh() | call <SID>TerminalBufEnter()
+        au BufLeave <buffer> stopinsert
+    else
+        call setbufvar("%","prevupdatetime",&updatetime)
+        exe 'set updatetime='.g:shellasync_update_interval
+        exe 'au BufEnter <buffer> set updatetime='.g:shellasync_update_interval.' | call <SID>TerminalBufEnter()'
+        au BufLeave <buffer> let &updatetime=getbufvar('%','prevupdatetime') | stopinsert
+        au CursorHold <buffer> call <SID>CursorHoldRefresh('ShellAsyncTerminalRefreshOutput')
+        au CursorHoldI <buffer> pythonx shellasync.ShellAsyncTerminalRefreshOutputI()
+    endif
     inoremap <silent> <buffer> <Enter> <ESC>:call <SID>TerminalEnterPressed() \| normal! 0<CR>
     inoremap <silent> <buffer> <Left> <ESC>:call <SID>TerminalLeftPressed()<CR>
     inoremap <silent> <buffer> <Right> <ESC>:call <SID>TerminalRightPressed()<CR>
@@ -518,7 +718,7 @@ function! shellasync#OpenShellTerminal()
     inoremap <silent> <buffer> <Down> <ESC>:call <SID>TerminalDownPressed()<CR>
     inoremap <silent> <buffer> <BS> <ESC>:call <SID>TerminalBackspacePressed()<CR>
     inoremap <silent> <buffer> <C-d> <ESC>:call <SID>TerminalCtrlDPressed()<CR>
-    nnoremap <silent> <buffer> <C-c> :call shellasync#TermShell([getbufvar('%','pid')])<CR>
+    nnoremap <silent> <buffer> <C-c> :exe 'pythonx shellasync.shellasync_terms['.b:termnr.'].interrupt()'<CR>
     nnoremap <silent> <buffer> t :call shellasync#TermShell([getbufvar('%','pid')])<CR>
     nnoremap <silent> <buffer> K :call shellasync#KillShell([getbufvar('%','pid')])<CR>
     nnoremap <silent> <buffer> s :call shellasync#SendShell(-1,0,0,[getbufvar('%','pid')])<CR>
@@ -0,0 +1,81 @@
+# Measures throughput of the line framer used by the reader on large inputs.
+#
+# usage: python3 bench/framer_throughput.py [--megabytes N] [--chunk BYTES] [--legacy]
+#
+# Synthetic input is fed in read sized chunks, the same way the reactor feeds
+# data it got from a pipe. --legacy runs the string concatenation and split
+# loop the reader used before, it is quadratic on long lines so keep
+# --megabytes small when using it.
+
+import argparse, json, os, sys, time, types
+
+SCENARIOS = {
+    'short_lines': (b'x' * 79) + b'\n',
+    'multibyte_lines': (u'шелл ✓ \U0001F600 '.encode('utf-8') * 6) + b'\n',
+    'long_lines': (b'{"k":"v"},' * 1677721) + b'\n',
+}
+
+def legacy(chunks):
+    out = ''
+    n = 0
+    for chunk in chunks:
+        out += chunk.decode('utf-8', 'ignore')
+        while out.find("\n") != -1:
+            out = out.split("\n")
+            n += len(out) - 1
+            out = out[-1]
+    return n
+
+def framer(shellasync, chunks):
+    f = shellasync.ShellAsyncLineFramer()
+    n = 0
+    for chunk in chunks:
+        n += len(f.feed(chunk))
+        f.remainder()
+    n += len(f.flush())
+    return n
+
+def chunked(pattern, total, size):
+    data = pattern * ((size + len(pattern)) // len(pattern) + 1)
+    pos = 0
+    sent = 0
+    while sent < total:
+        n = min(size, total - sent)
+        yield data[pos:pos + n]
+        pos = (pos + n) % len(pattern)
+        sent += n
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--megabytes', type=int, default=2048)
+    parser.add_argument('--chunk', type=int, default=65536)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    sys.modules.setdefault('vim', types.ModuleType('vim'))
+    sys.path.insert(0, args.module)
+    import shellasync
+
+    total = args.megabytes * 1024 * 1024
+    results = []
+    for name in sorted(SCENARIOS):
+        start = time.time()
+        if args.legacy:
+            lines = legacy(chunked(SCENARIOS[name], total, args.chunk))
+        else:
+            lines = framer(shellasync, chunked(SCENARIOS[name], total, args.chunk))
+        elapsed = time.time() - start
+        results.append({
+            'scenario': name,
+            'implementation': 'legacy' if args.legacy else 'framer',
+            'megabytes': args.megabytes,
+            'lines': lines,
+            'seconds': round(elapsed, 3),
+            'megabytes_per_second': round(args.megabytes / elapsed, 1),
+        })
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Counts thread wakeups per second of shellasync while a number of jobs sit idle.
+#
+# usage: python3 bench/idle_wakeups.py [--module DIR] [--jobs N] [--seconds S]
+#
+# DIR defaults to autoload/py3, point it at a checkout of an older version of
+# shellasync.py to get the "before" numbers, for example:
+#
+#   mkdir /tmp/old && git show bb9a2f5:autoload/py3/shellasync.py > /tmp/old/shellasync.py
+#   python3 bench/idle_wakeups.py --module /tmp/old
+#
+# Wakeups are measured as voluntary context switches of all threads of the
+# benchmark process (linux only) since every wakeup from poll/select/sleep
+# is preceded by a voluntary switch.
+
+import argparse, glob, json, os, resource, sys, time, types
+
+def context_switches():
+    total = 0
+    for status in glob.glob('/proc/self/task/*/status'):
+        try:
+            for line in open(status):
+                if line.startswith('voluntary_ctxt_switches:'):
+                    total += int(line.split()[1])
+        except IOError:
+            pass
+    return total
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    sys.modules.setdefault('vim', types.ModuleType('vim'))
+    sys.path.insert(0, args.module)
+    import shellasync
+
+    jobs = []
+    for i in range(args.jobs):
+        out = shellasync.ShellAsyncOutput()
+        out.startProcess('sleep 100000', None, None, False)
+        jobs.append(out)
+    time.sleep(0.5)
+
+    cs = context_switches()
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    time.sleep(args.seconds)
+    elapsed = time.time() - start
+    cs = context_switches() - cs
+    cpu2 = resource.getrusage(resource.RUSAGE_SELF)
+
+    for out in jobs:
+        os.killpg(out.pid(), 9)
+    for out in jobs:
+        out.join(5.0)
+
+    print(json.dumps({
+        'module': args.module,
+        'jobs': args.jobs,
+        'seconds': round(elapsed, 3),
+        'wakeups_per_second': round(cs / elapsed, 1),
+        'cpu_seconds': round((cpu2.ru_utime - cpu.ru_utime) + (cpu2.ru_stime - cpu.ru_stime), 4),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
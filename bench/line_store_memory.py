@@ -0,0 +1,96 @@
+# Measures memory retained by output of a command that vim hasn't fetched yet,
+# like output of a command whose buffer is hidden, and the time it takes to
+# store and fetch it.
+#
+# usage: python3 bench/line_store_memory.py [--module DIR] [--lines N] [--width N]
+#
+# --lines short lines of --width characters are handed to ShellAsyncOutput.extend
+# the same way the reactor thread hands over output read from a command, then
+# fetched in batches of 1024 lines the way vim fetches them. Memory is measured
+# with tracemalloc so it doesn't include memory freed before the measurement
+# and is compared to keeping the same lines in a list of str. Pass an older
+# shellasync.py with --module to compare against it.
+
+import argparse, gc, json, os, sys, time, tracemalloc
+
+def load(name, path):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(build):
+    # memory kept by what build returns, timed separately since tracing slows allocations down
+    gc.collect()
+    start = time.time()
+    kept = build()
+    elapsed = time.time()-start
+    del kept
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (kept, size, elapsed)
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--width', type=int, default=8)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import vimstub
+    vimstub.install()
+    shellasync = load('shellasync', os.path.join(args.module, 'shellasync.py'))
+
+    form = '%0'+str(args.width)+'d'
+
+    # lines are created while storing them like the reactor thread decodes them from output
+    def batches():
+        for start in range(0, args.lines, 4096):
+            yield [form % i for i in range(start, min(start+4096, args.lines))]
+
+    def plain():
+        lines = []
+        for batch in batches():
+            lines.extend(batch)
+        return lines
+
+    def output():
+        out = shellasync.ShellAsyncOutput()
+        for batch in batches():
+            out.extend(batch)
+        return out
+
+    reference, listbytes, listtime = measure(plain)
+    del reference
+    out, outputbytes, extendtime = measure(output)
+    start = time.time()
+    fetched = 0
+    while True:
+        got = out.get(1024)
+        if got == None:
+            break
+        fetched += len(got[2])
+    fetchtime = time.time()-start
+    assert fetched == args.lines, fetched
+
+    print(json.dumps({
+        'module': args.module,
+        'lines': args.lines,
+        'width': args.width,
+        'list_bytes': listbytes,
+        'list_bytes_per_line': round(float(listbytes)/args.lines, 1),
+        'output_bytes': outputbytes,
+        'output_bytes_per_line': round(float(outputbytes)/args.lines, 1),
+        'extend_seconds': round(extendtime, 3),
+        'fetch_seconds': round(fetchtime, 3),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
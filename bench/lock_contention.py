@@ -0,0 +1,91 @@
+# Measures contention on the lock of ShellAsyncOutput while a command floods
+# output and vim polls the state of the command on every tick.
+#
+# usage: python3 bench/lock_contention.py [--module DIR] [--lines N] [--interval MS]
+#
+# The lock of the measured ShellAsyncOutput is replaced with the
+# ShellAsyncTimedLock of autoload/py3 so older versions of shellasync.py
+# passed with --module can be measured the same way. Every tick calls the
+# accessors vim uses while refreshing and fetches at most --batch lines.
+# Reported times are in milliseconds, tick times are the time vim spent
+# in the accessors and fetching.
+
+import argparse, json, os, sys, time
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+def load(name, path):
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    import imp
+    return imp.load_source(name, path)
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--batch', type=int, default=1024)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import vimstub
+    vimstub.install()
+    current = load('shellasync_current', os.path.join(root, 'autoload', 'py3', 'shellasync.py'))
+    shellasync = load('shellasync', os.path.join(args.module, 'shellasync.py'))
+
+    out = shellasync.ShellAsyncOutput()
+    lock = current.ShellAsyncTimedLock()
+    out.lock = lock
+    start = time.time()
+    out.startProcess('seq 1 %d' % args.lines, None, None, False)
+    ticks = []
+    fetched = 0
+    while True:
+        done = not out.isAlive()
+        tick = time.time()
+        out.isRunning()
+        out.isWaitingForInput()
+        out.getRemainder()
+        out.hasdata()
+        out.hasnewdata()
+        out.pid()
+        out.returnValue()
+        out.processCommand()
+        r = out.get(args.batch)
+        if r != None:
+            fetched += len(r[2])
+        ticks.append(time.time() - tick)
+        if done and r == None:
+            break
+        time.sleep(args.interval/1000.0)
+    elapsed = time.time() - start
+
+    stats = lock.stats()
+    print(json.dumps({
+        'module': args.module,
+        'lines': fetched,
+        'seconds': round(elapsed, 3),
+        'ticks': len(ticks),
+        'tick_p50_ms': round(percentile(ticks, 50)*1000, 4),
+        'tick_p99_ms': round(percentile(ticks, 99)*1000, 4),
+        'tick_max_ms': round(max(ticks)*1000, 4),
+        'lock_acquires': stats['acquires'],
+        'lock_contended': stats['contended'],
+        'lock_wait_ms': round(stats['wait']*1000, 3),
+        'lock_max_wait_ms': round(stats['maxwait']*1000, 3),
+        'lock_hold_ms': round(stats['hold']*1000, 3),
+        'lock_max_hold_ms': round(stats['maxhold']*1000, 3),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Measures how fast output of a flooding command reaches the buffer and how
+# long the longest refresh (UI stall) takes.
+#
+# usage: python3 bench/refresh_throughput.py [--module DIR] [--lines N] [--interval MS]
+#
+# A refresh is run every --interval milliseconds like CursorHold would,
+# using the headless vim stand-in from bench/vimstub.py. Cost of vim's
+# buffer appends and ex commands is simulated with --append-cost,
+# --line-cost and --command-cost (microseconds).
+
+import argparse, json, os, sys, time
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--interval', type=float, default=10.0)
+    parser.add_argument('--budget', type=float, default=8.0)
+    parser.add_argument('--append-cost', type=float, default=50.0)
+    parser.add_argument('--line-cost', type=float, default=1.0)
+    parser.add_argument('--command-cost', type=float, default=200.0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import vimstub
+    vimstub.install()
+    vimstub.g['shellasync_refresh_budget'] = args.budget
+    vimstub.costs['append'] = args.append_cost/1000000.0
+    vimstub.costs['append_line'] = args.line_cost/1000000.0
+    vimstub.costs['command'] = args.command_cost/1000000.0
+    sys.path.insert(0, args.module)
+    import shellasync
+
+    vimstub.evals['command'] = 'seq 1 %d' % args.lines
+    vimstub.evals['cwd'] = os.getcwd()
+    b = vimstub.current.buffer
+    start = time.time()
+    pid = shellasync.ShellAsyncExecuteCmd(True, dict(os.environ))
+    out = shellasync.shellasync_cmds[pid]
+    stalls = []
+    while True:
+        done = not out.isAlive()
+        tick = time.time()
+        shellasync.ShellAsyncRefreshOutput()
+        stalls.append((time.time()-tick)*1000.0)
+        if done and not out.hasdata():
+            break
+        time.sleep(args.interval/1000.0)
+    elapsed = time.time()-start
+
+    print(json.dumps({
+        'module': args.module,
+        'lines': len(b),
+        'seconds': round(elapsed, 3),
+        'lines_per_second': round(len(b)/elapsed, 1),
+        'refreshes': len(stalls),
+        'stall_ms_p50': round(percentile(stalls, 50), 3),
+        'stall_ms_p99': round(percentile(stalls, 99), 3),
+        'stall_ms_max': round(max(stalls), 3),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# Measures how vim's refresh tick, threads and CPU scale with the number of
+# commands running at once.
+#
+# usage: python3 bench/scale.py [--module DIR] [--jobs N ...] [--seconds S]
+#                               [--interval MS] [--scrollback N] [--flood N]
+#
+# For every job count (10, 50, 200 and 500 by default) that many commands
+# are started with ShellAsyncExecuteCmd, each in its own buffer: 70% idle
+# (sleep), 20% trickling a line every 100ms and 10% flooding --flood lines
+# every 100ms, 1000 by default, which adds up to 500000 lines a second
+# with 500 jobs. An unthrottled flood like yes takes all CPU the reactor
+# thread gets on its own and would hide how the job count matters. Every
+# buffer keeps --scrollback lines like g:shellasync_scrollback_lines does so
+# output of buffers that aren't shown doesn't grow without bound. For
+# --seconds a vim tick every --interval milliseconds refreshes the focused
+# buffer, which shows one of the flooding commands, and rebuilds :ShellList.
+#
+# Reported per job count:
+#   start_seconds  time to start all commands
+#   tick_ms        duration of vim ticks (p50/p90/p99/max)
+#   threads        python threads and threads of the process
+#   gil_wait_ms    how late a probe thread sleeping 1ms wakes up, time it
+#                  waits for the GIL held by other threads (p50/p99/max)
+#   cpu_percent    CPU used by this process during the measurement
+#   fds            open file descriptors
+
+import argparse, json, os, resource, signal, sys, threading, time
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+def milliseconds(values, ps=(50, 90, 99)):
+    values = [v*1000.0 for v in values]
+    result = dict([('p%d' % p, round(percentile(values, p), 3)) for p in ps])
+    result['max'] = round(max(values) if len(values) > 0 else 0.0, 3)
+    return result
+
+def load(name, path):
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    import imp
+    return imp.load_source(name, path)
+
+def osthreads():
+    try:
+        f = open('/proc/self/status')
+        for line in f:
+            if line.startswith('Threads:'):
+                f.close()
+                return int(line.split()[1])
+        f.close()
+    except (IOError, OSError):
+        pass
+    return -1
+
+def fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except (IOError, OSError):
+        return -1
+
+class Probe(threading.Thread):
+    # sleeps 1ms in a loop and records how late it wakes up
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.running = True
+        self.late = []
+
+    def run(self):
+        while self.running:
+            start = time.time()
+            time.sleep(0.001)
+            self.late.append(max(0.0, time.time()-start-0.001))
+
+def command(i, flood):
+    if i % 10 == 0:
+        return "while :; do seq 1 %d; sleep 0.1; done" % flood
+    if i % 10 in (1, 2):
+        return "while :; do echo trickle; sleep 0.1; done"
+    return 'sleep 3600'
+
+def measure(shellasync, vimstub, jobs, seconds, interval, scrollback, flood):
+    windows = []
+    pids = []
+    try:
+        return run(shellasync, vimstub, jobs, seconds, interval, scrollback, flood, windows, pids)
+    finally:
+        for pid in pids:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pid in pids:
+            if pid in shellasync.shellasync_cmds:
+                shellasync.shellasync_cmds[pid].join(10.0)
+                shellasync.ShellAsyncDeleteCmd(pid)
+        for w in windows:
+            vimstub.windows.remove(w)
+            del vimstub.buffers[w.buffer.number]
+
+def run(shellasync, vimstub, jobs, seconds, interval, scrollback, flood, windows, pids):
+    start = time.time()
+    for i in range(jobs):
+        w = vimstub.newwindow()
+        w.buffer.options['filetype'] = 'shellasync'
+        w.buffer.vars['scrollback'] = str(scrollback)
+        vimstub.evals['command'] = command(i, flood)
+        pid = shellasync.ShellAsyncExecuteCmd(True, None)
+        windows.append(w)
+        pids.append(pid)
+    started = time.time()-start
+    focused = windows[0]
+    listwindow = vimstub.newwindow()
+    listwindow.buffer.options['filetype'] = 'shellasynclist'
+    windows.append(listwindow)
+
+    probe = Probe()
+    probe.start()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    ticks = []
+    while time.time()-start < seconds:
+        tick = time.time()
+        vimstub.current.window = focused
+        vimstub.current.buffer = focused.buffer
+        shellasync.ShellAsyncRefreshOutput()
+        vimstub.current.window = listwindow
+        vimstub.current.buffer = listwindow.buffer
+        shellasync.ShellAsyncListShells()
+        ticks.append(time.time()-tick)
+        time.sleep(max(0.0, interval-(time.time()-tick)))
+    elapsed = time.time()-start
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    report = {'jobs': jobs, 'start_seconds': round(started, 3), 'ticks': len(ticks),
+              'tick_ms': milliseconds(ticks), 'threads': threading.active_count(), 'os_threads': osthreads(),
+              'cpu_percent': round((end.ru_utime-usage.ru_utime+end.ru_stime-usage.ru_stime)*100.0/elapsed, 1),
+              'fds': fds(), 'focused_lines': len(focused.buffer)}
+    probe.running = False
+    probe.join()
+    report['gil_wait_ms'] = milliseconds(probe.late, (50, 99))
+    return report
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--jobs', type=int, action='append')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--interval', type=float, default=100.0)
+    parser.add_argument('--scrollback', type=int, default=1000)
+    parser.add_argument('--flood', type=int, default=1000)
+    args = parser.parse_args()
+
+    # commands are killed on the way out when interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    # every command needs a few file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import vimstub
+    vimstub.install()
+    vimstub.evals['cwd'] = os.getcwd()
+    vimstub.evals["getpos('.')"] = ['0', '1', '1', '0']
+    shellasync = load('shellasync', os.path.join(args.module, 'shellasync.py'))
+
+    results = []
+    for jobs in args.jobs or [10, 50, 200, 500]:
+        results.append(measure(shellasync, vimstub, jobs, args.seconds, args.interval/1000.0, args.scrollback, args.flood))
+        sys.stderr.write(str(jobs)+' jobs done\n')
+    print(json.dumps({'module': args.module, 'python': sys.version.split()[0], 'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                      'interval_ms': args.interval, 'seconds': args.seconds, 'flood': args.flood, 'results': results}, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
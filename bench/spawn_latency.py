@@ -0,0 +1,59 @@
+# Measures how long starting a command takes from a process as big as Vim.
+#
+# usage: python3 bench/spawn_latency.py [--rss-mb MB] [--runs N] [--command CMD]
+#
+# The benchmark first grows its own resident memory to MB megabytes and then
+# starts CMD (default "true") N times in each of the ways shellasync has
+# started commands:
+#
+#   legacy  /bin/sh with " 2>&1" appended and preexec_fn=os.setsid, forces
+#           subprocess to fork() and copy page tables of the whole process
+#   shell   /bin/sh with start_new_session and stderr merged on fd level,
+#           subprocess can use vfork/posix_spawn
+#   direct  arguments split with shlex and executed without /bin/sh
+#
+# For each way it reports percentiles of time spent inside Popen(), which is
+# the time the calling thread is blocked, and of time until command exited.
+
+import argparse, json, os, resource, shlex, subprocess, sys, time
+
+def percentiles(values):
+    values = sorted(values)
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000.0, 3)
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': round(values[-1] * 1000.0, 3)}
+
+def spawn(mode, cmd):
+    if mode == 'legacy':
+        return subprocess.Popen(cmd + " 2>&1", shell=True, preexec_fn=os.setsid, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if mode == 'shell':
+        return subprocess.Popen(cmd, shell=True, start_new_session=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return subprocess.Popen(shlex.split(cmd), start_new_session=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rss-mb', type=int, default=1024)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--command', default='true')
+    args = parser.parse_args()
+
+    # touch every page so it's resident and has to be mapped in a forked child
+    ballast = bytearray(args.rss_mb * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    results = {'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, 'command': args.command, 'runs': args.runs}
+    for mode in ('legacy', 'shell', 'direct'):
+        popen = []
+        total = []
+        for i in range(args.runs):
+            start = time.time()
+            p = spawn(mode, args.command)
+            popen.append(time.time() - start)
+            p.communicate()
+            total.append(time.time() - start)
+        results[mode] = {'popen': percentiles(popen), 'exit': percentiles(total)}
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
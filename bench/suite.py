@@ -0,0 +1,294 @@
+# Benchmark suite running commands through the same entry points vim uses,
+# with the headless vim stand-in from vimstub.py instead of a live vim.
+#
+# usage: python3 bench/suite.py [--module DIR] [--scenario NAME ...] [--scale X]
+#                               [--interval MS] [--output FILE]
+#
+# Every scenario starts a synthetic producer with ShellAsyncExecuteCmd in a
+# new buffer, or in a ShellTerminal for the terminal scenario, and refreshes
+# it with ShellAsyncRefreshOutput the way the refresh timer does (through
+# ShellAsyncRefreshWindows for the persistent scenario): right away
+# while output is waiting and every --interval milliseconds otherwise, until
+# the command finished and all of its output is in the buffer.
+#
+# Scenarios:
+#   flood     lines written as fast as possible
+#   longline  one huge line without newlines until the end
+#   progress  progress bar redrawn with carriage returns
+#   ansi      lines full of SGR color sequences
+#   trickle   a line every 10ms carrying the time it was written, measures
+#             latency from write to buffer
+#   paste     big paste written to stdin of cat
+#   terminal  flood in a ShellTerminal buffer
+#   persistent  flood in a ShellTerminal running commands in a persistent
+#             shell, followed by short commands measuring how long it takes
+#             until each of them is shown as finished
+#
+# For each scenario the suite reports wall time, throughput, vim stall time
+# per refresh tick (p50/p90/p99/max), CPU time of this process (vim and
+# reactor thread) and of the producer, and resident memory, as JSON that can
+# be compared between versions by passing an older shellasync.py directory
+# with --module. --scale multiplies the amount of output of every scenario.
+
+import argparse, json, os, resource, sys, tempfile, time
+
+PRODUCER = r'''
+import os, sys, time
+mode = sys.argv[1]
+n = int(sys.argv[2])
+def write(data):
+    while len(data) > 0:
+        data = data[os.write(1, data):]
+if mode == 'flood':
+    for start in range(0, n, 4096):
+        write(b''.join([b'flood output line number %d\n' % i for i in range(start, min(start+4096, n))]))
+elif mode == 'longline':
+    block = b'x'*65536
+    for i in range(n//65536):
+        write(block)
+    write(b'x'*(n % 65536)+b'\n')
+elif mode == 'progress':
+    for start in range(0, n, 256):
+        write(b''.join([b'\r%3d%% [%-50s]' % (i*100//n, b'#'*(i*50//n)) for i in range(start, min(start+256, n))]))
+    write(b'\rdone\n')
+elif mode == 'ansi':
+    line = b'\x1b[1;32mok\x1b[0m \x1b[33m%d\x1b[0m \x1b[38;5;208mwarning\x1b[0m \x1b[48;2;10;20;30m\x1b[4mtext\x1b[0m\n'
+    for start in range(0, n, 1024):
+        write(b''.join([line % i for i in range(start, min(start+1024, n))]))
+elif mode == 'trickle':
+    for i in range(n):
+        write(('%.6f\n' % time.time()).encode('ascii'))
+        time.sleep(0.01)
+'''
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+def milliseconds(values):
+    values = [v*1000.0 for v in values]
+    return {'p50': round(percentile(values, 50), 3), 'p90': round(percentile(values, 90), 3),
+            'p99': round(percentile(values, 99), 3), 'max': round(max(values) if len(values) > 0 else 0.0, 3)}
+
+def rss():
+    # resident memory of this process in megabytes
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return round(pages*resource.getpagesize()/1048576.0, 1)
+    except (IOError, OSError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 1)
+
+def load(name, path):
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    import imp
+    return imp.load_source(name, path)
+
+class Suite(object):
+    def __init__(self, shellasync, vimstub, producer, interval, python):
+        self.shellasync = shellasync
+        self.vimstub = vimstub
+        self.producer = producer
+        self.interval = interval
+        self.python = python
+
+    def command(self, mode, n):
+        return self.python+' '+self.producer+' '+mode+' '+str(n)
+
+    def window(self, filetype):
+        w = self.vimstub.newwindow()
+        w.buffer.options['filetype'] = filetype
+        return w.buffer
+
+    def run(self, buffer, refresh, done, tick=None):
+        # refreshes buffer like the refresh timer until done() returns True
+        ticks = []
+        while True:
+            finished = done()
+            t = time.time()
+            refresh()
+            ticks.append(time.time()-t)
+            if tick != None:
+                tick()
+            if finished:
+                break
+            output = self.output(buffer)
+            if output == None or not output.hasdata():
+                time.sleep(self.interval)
+        return ticks
+
+    def output(self, buffer):
+        pid = buffer.vars.get('pid', '')
+        if pid == '' or not int(pid) in self.shellasync.shellasync_cmds:
+            return None
+        return self.shellasync.shellasync_cmds[int(pid)]
+
+    def shell(self, command, write=None, tick=None):
+        # runs command in new shellasync buffer, write is called with output of started command
+        s = self.shellasync
+        buffer = self.window('shellasync')
+        self.vimstub.evals['command'] = command
+        start = time.time()
+        pid = s.ShellAsyncExecuteCmd(True, None)
+        output = s.shellasync_cmds[pid]
+        if write != None:
+            write(output)
+        ticks = self.run(buffer, s.ShellAsyncRefreshOutput, lambda: not output.isAlive() and not output.hasdata(), tick)
+        elapsed = time.time()-start
+        s.ShellAsyncDeleteCmd(pid)
+        return (buffer, elapsed, ticks)
+
+    def terminal(self, command, persistent=False, commands=0):
+        # persistent shell stays alive after each command so it's refreshed the way the refresh
+        # timer does it, commands is the number of short commands run after the first one
+        s = self.shellasync
+        buffer = self.window('shellasyncterm')
+        buffer.vars.update({'pl': '1', 'cfinished': '0'})
+        self.vimstub.g['shellasync_terminal_persistent'] = 1 if persistent else 0
+        refresh = s.ShellAsyncRefreshWindows if persistent else s.ShellAsyncTerminalRefreshOutput
+        finished = lambda: buffer.vars.get('cfinished') in (1, '1')
+        term = s.ShellAsyncTerminal()
+        self.vimstub.evals['command'] = command
+        start = time.time()
+        term.execute()
+        ticks = self.run(buffer, refresh, finished)
+        elapsed = time.time()-start
+        latencies = []
+        for i in range(commands):
+            buffer.vars['cfinished'] = '0'
+            self.vimstub.evals['command'] = 'true'
+            t = time.time()
+            term.execute()
+            self.run(buffer, refresh, finished)
+            latencies.append(time.time()-t)
+        self.vimstub.g['shellasync_terminal_persistent'] = 0
+        pid = term.shell if persistent else term.pid
+        if persistent:
+            s.ShellAsyncKillCmd(pid)
+            s.shellasync_cmds[pid].join(5)
+        s.ShellAsyncDeleteCmd(pid)
+        if persistent:
+            return (buffer, elapsed, ticks, {'command_ms': milliseconds(latencies), 'commands': commands})
+        return (buffer, elapsed, ticks)
+
+    def measure(self, n, scenario):
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = scenario(n)
+        self_end = resource.getrusage(resource.RUSAGE_SELF)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        buffer, elapsed, ticks = result[:3]
+        report = {'n': n, 'seconds': round(elapsed, 3), 'buffer_lines': len(buffer),
+                  'buffer_bytes': sum([len(l)+1 for l in buffer]), 'ticks': len(ticks),
+                  'tick_ms': milliseconds(ticks),
+                  'cpu_seconds': round(self_end.ru_utime-self_start.ru_utime+self_end.ru_stime-self_start.ru_stime, 3),
+                  'producer_cpu_seconds': round(children_end.ru_utime-children_start.ru_utime+children_end.ru_stime-children_start.ru_stime, 3),
+                  'rss_mb': rss()}
+        report['lines_per_second'] = round(report['buffer_lines']/max(elapsed, 0.000001), 1)
+        report['mb_per_second'] = round(report['buffer_bytes']/max(elapsed, 0.000001)/1048576.0, 2)
+        if len(result) > 3:
+            report.update(result[3])
+        # buffer isn't needed anymore, keep memory of next scenarios comparable
+        buffer[:] = None
+        return report
+
+    def flood(self, n):
+        return self.shell(self.command('flood', n))
+
+    def longline(self, n):
+        return self.shell(self.command('longline', n))
+
+    def progress(self, n):
+        return self.shell(self.command('progress', n))
+
+    def ansi(self, n):
+        return self.shell(self.command('ansi', n))
+
+    def trickle(self, n):
+        latencies = []
+        state = {'seen': 0}
+        def tick():
+            # lines carry the time they were written, latency is measured when they show up in buffer
+            b = self.vimstub.current.buffer
+            now = time.time()
+            for i in range(state['seen'], len(b)):
+                try:
+                    latencies.append(now-float(b[i]))
+                except ValueError:
+                    continue
+            if len(b) > 1 or b[0] != '':
+                state['seen'] = len(b)
+        result = self.shell(self.command('trickle', n), None, tick)
+        return result+({'latency_ms': milliseconds(latencies), 'latency_lines': len(latencies)},)
+
+    def paste(self, n):
+        lines = ['pasted line number %d' % i for i in range(n)]
+        def write(output):
+            output.write(lines)
+            output.writenonl('\x04')
+        return self.shell('cat', write)
+
+    def terminal_flood(self, n):
+        return self.terminal(self.command('flood', n))
+
+    def persistent(self, n):
+        return self.terminal(self.command('flood', n), True, 20)
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    scenarios = [('flood', 500000), ('longline', 8*1048576), ('progress', 100000), ('ansi', 100000),
+                 ('trickle', 200), ('paste', 100000), ('terminal', 200000), ('persistent', 200000)]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=os.path.join(root, 'autoload', 'py3'))
+    parser.add_argument('--scenario', action='append', choices=[s[0] for s in scenarios])
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--interval', type=float, default=100.0)
+    parser.add_argument('--python', default=sys.executable)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import vimstub
+    vimstub.install()
+    vimstub.evals['cwd'] = os.getcwd()
+    vimstub.evals['getcwd()'] = os.getcwd()
+    shellasync = load('shellasync', os.path.join(args.module, 'shellasync.py'))
+
+    directory = tempfile.mkdtemp(prefix='shellasync-bench')
+    producer = os.path.join(directory, 'producer.py')
+    f = open(producer, 'w')
+    f.write(PRODUCER)
+    f.close()
+
+    suite = Suite(shellasync, vimstub, producer, args.interval/1000.0, args.python)
+    report = {'module': args.module, 'python': sys.version.split()[0], 'interval_ms': args.interval,
+              'scale': args.scale, 'scenarios': {}}
+    try:
+        for name, n in scenarios:
+            if args.scenario != None and not name in args.scenario:
+                continue
+            n = max(1, int(n*args.scale))
+            scenario = getattr(suite, 'terminal_flood' if name == 'terminal' else name)
+            report['scenarios'][name] = suite.measure(n, scenario)
+            sys.stderr.write(name+' done\n')
+    finally:
+        os.remove(producer)
+        os.rmdir(directory)
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 1)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output != None:
+        f = open(args.output, 'w')
+        f.write(text+'\n')
+        f.close()
+    print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# Headless stand-in for vim's python module, just enough of it for running
+# shellasync.py outside of vim in benchmarks.
+#
+# import vimstub; vimstub.install() before importing shellasync.
+
+import re, sys, time
+
+# simulated cost in seconds of buffer appends and ex commands, these hold the
+# GIL just like vim does while it executes them, all zero by default
+costs = {'append': 0.0, 'append_line': 0.0, 'command': 0.0}
+
+def spend(seconds):
+    if seconds > 0:
+        end = time.time()+seconds
+        while time.time() < end:
+            pass
+
+class Buffer(list):
+    def __init__(self, number, name=''):
+        list.__init__(self, [''])
+        self.number = number
+        self.name = name
+        self.vars = {}
+        self.options = {}
+
+    def append(self, lines, nr=None):
+        if not isinstance(lines, (list, tuple)):
+            lines = [lines]
+        spend(costs['append']+costs['append_line']*len(lines))
+        if nr == None:
+            self.extend(lines)
+        else:
+            self[nr:nr] = list(lines)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            list.__setitem__(self, key, [] if value == None else value)
+        elif value == None:
+            list.__delitem__(self, key)
+        else:
+            list.__setitem__(self, key, value)
+        if len(self) == 0:
+            list.append(self, '')
+
+    def __delitem__(self, key):
+        list.__delitem__(self, key)
+        if len(self) == 0:
+            list.append(self, '')
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+class Window(object):
+    def __init__(self, buffer, number):
+        self.buffer = buffer
+        self.number = number
+        self.cursor = (1, 0)
+        self.vars = {}
+
+class Current(object):
+    pass
+
+buffers = {}
+windows = []
+current = Current()
+g = {}
+mode = 'n'
+evals = {}
+commands = []
+
+def newbuffer(name=''):
+    b = Buffer(len(buffers)+1, name)
+    buffers[b.number] = b
+    return b
+
+def newwindow(buffer=None):
+    if buffer == None:
+        buffer = newbuffer()
+    w = Window(buffer, len(windows)+1)
+    windows.append(w)
+    current.window = w
+    current.buffer = buffer
+    return w
+
+def value(v):
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    if isinstance(v, int):
+        return str(v)
+    return v
+
+def buffer(expr):
+    expr = expr.strip()
+    if expr in ("'%'", '"%"'):
+        return current.buffer
+    return buffers[int(expr)]
+
+def eval(expr):
+    m = re.match(r"^getbufvar\(([^,]+),'([^']+)'\)$", expr)
+    if m:
+        b = buffer(m.group(1))
+        if m.group(2).startswith('&'):
+            return value(b.options.get(m.group(2)[1:], ''))
+        return value(b.vars.get(m.group(2), ''))
+    m = re.match(r"^setbufvar\(([^,]+),'([^']+)',(.*)\)$", expr)
+    if m:
+        buffer(m.group(1)).vars[m.group(2)] = m.group(3).strip("'")
+        return '0'
+    m = re.match(r"^g:(\w+)$", expr)
+    if m:
+        return value(g[m.group(1)])
+    if expr == "mode()":
+        return mode
+    if expr == "exists('*win_execute')":
+        return '1'
+    if expr == "&filetype == 'shellasyncterm'":
+        return value(current.buffer.options.get('filetype') == 'shellasyncterm')
+    if expr == "line2byte(line('$')+1)":
+        return str(sum([len(l)+1 for l in current.buffer])+1)
+    m = re.match(r"^byte2line\((\d+)\)$", expr)
+    if m:
+        n = int(m.group(1))
+        offset = 1
+        for i in range(len(current.buffer)):
+            offset += len(current.buffer[i])+1
+            if offset > n:
+                return str(i+1)
+        return str(len(current.buffer))
+    return evals.get(expr, '')
+
+def command(cmd):
+    commands.append(cmd)
+    spend(costs['command'])
+    m = re.match(r"^let b:(\w+) = (.*)$", cmd)
+    if m:
+        current.buffer.vars[m.group(1)] = m.group(2)
+    elif cmd == 'normal! G0':
+        current.window.cursor = (len(current.buffer), 0)
+    m = re.match(r"^call win_execute\(win_getid\((\d+)\), 'pythonx (.*)'\)$", cmd)
+    if m:
+        win_execute(windows[int(m.group(1))-1], m.group(2))
+
+def win_execute(window, statement):
+    previous = current.window
+    current.window = window
+    current.buffer = window.buffer
+    try:
+        exec(statement, sys.modules['__main__'].__dict__)
+    finally:
+        current.window = previous
+        current.buffer = previous.buffer
+
+def install():
+    sys.modules['vim'] = sys.modules[__name__]
+    if len(windows) == 0:
+        newwindow()
+    g.setdefault('shellasync_print_return_value', 0)
+    g.setdefault('shellasync_encoding', 'utf-8')
+    g.setdefault('shellasync_encoding_errors', 'ignore')
+    g.setdefault('shellasync_refresh_budget', 8)
+    g.setdefault('shellasync_update_interval', 100)
+    g.setdefault('shellasync_pty', 0)
+    g.setdefault('shellasync_pty_size', ['24', '80'])
+    g.setdefault('shellasync_pty_term', 'dumb')
+    g.setdefault('shellasync_direct_exec', 1)
+    g.setdefault('shellasync_ansi_colors', 1)
+    g.setdefault('shellasync_terminate_timeout', 3000)
+    g.setdefault('shellasync_shutdown_timeout', 2000)
+    g.setdefault('shellasync_keep_finished', 100)
+    g.setdefault('shellasync_keep_finished_bytes', 67108864)
+    g.setdefault('shellasync_keep_finished_seconds', 0)
+    g.setdefault('shellasync_terminal_persistent', 0)
+    evals.setdefault("exists('*prop_add_list') ? 2 : has('textprop') ? 1 : 0", '2')
+    evals.setdefault("&t_Co", '256')
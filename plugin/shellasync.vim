@@ -29,6 +29,82 @@ if !exists("g:shellasync_update_interval")
     let g:shellasync_update_interval = 100
 endif
 
+if !exists("g:shellasync_refresh_budget")
+    let g:shellasync_refresh_budget = 8
+endif
+
+if !exists("g:shellasync_encoding")
+    let g:shellasync_encoding = 'utf-8'
+endif
+
+if !exists("g:shellasync_encoding_errors")
+    let g:shellasync_encoding_errors = 'ignore'
+endif
+
+if !exists("g:shellasync_scrollback_lines")
+    let g:shellasync_scrollback_lines = 0
+endif
+
+if !exists("g:shellasync_scrollback_bytes")
+    let g:shellasync_scrollback_bytes = 0
+endif
+
+if !exists("g:shellasync_spool")
+    let g:shellasync_spool = 0
+endif
+
+if !exists("g:shellasync_spool_window")
+    let g:shellasync_spool_window = 10000
+endif
+
+if !exists("g:shellasync_pty")
+    let g:shellasync_pty = 0
+endif
+
+if !exists("g:shellasync_pty_size")
+    let g:shellasync_pty_size = [24, 80]
+endif
+
+if !exists("g:shellasync_pty_term")
+    let g:shellasync_pty_term = 'dumb'
+endif
+
+if !exists("g:shellasync_direct_exec")
+    let g:shellasync_direct_exec = 1
+endif
+
+if !exists("g:shellasync_ansi_colors")
+    let g:shellasync_ansi_colors = 1
+endif
+
+if !exists("g:shellasync_terminate_timeout")
+    let g:shellasync_terminate_timeout = 3000
+endif
+
+if !exists("g:shellasync_shutdown_timeout")
+    let g:shellasync_shutdown_timeout = 2000
+endif
+
+if !exists("g:shellasync_keep_finished")
+    let g:shellasync_keep_finished = 100
+endif
+
+if !exists("g:shellasync_keep_finished_bytes")
+    let g:shellasync_keep_finished_bytes = 67108864
+endif
+
+if !exists("g:shellasync_keep_finished_seconds")
+    let g:shellasync_keep_finished_seconds = 0
+endif
+
+if !exists("g:shellasync_trace")
+    let g:shellasync_trace = 0
+endif
+
+if !exists("g:shellasync_terminal_persistent")
+    let g:shellasync_terminal_persistent = 0
+endif
+
 if !exists("g:shellasync_terminal_prompt")
     let g:shellasync_terminal_prompt = "'$ '"
 endif
@@ -44,12 +120,19 @@ command! -complete=shellcmd -bang -nargs=+ ShellNew call shellasync#ExecuteInShe
 command! -complete=customlist,<SID>ShellPidCompletion -nargs=* ShellTerm call shellasync#TermShell(shellasync#GetPidList(<f-args>))
 command! -complete=customlist,<SID>ShellPidCompletion -nargs=* ShellKill call shellasync#KillShell(shellasync#GetPidList(<f-args>))
 command! -complete=customlist,<SID>ShellPidCompletion -nargs=* ShellDelete call shellasync#DeleteShell(shellasync#GetPidList(<f-args>))
+command! -complete=customlist,<SID>ShellPidCompletion -nargs=* ShellOpen call shellasync#OpenShell(shellasync#GetPidList(<f-args>))
+command! -complete=customlist,<SID>ShellPidCompletion -nargs=* ShellStats call shellasync#StatsShell(shellasync#GetPidList(<f-args>))
 command! -complete=customlist,<SID>ShellPidCompletion -nargs=* -range ShellSend call shellasync#SendShell(<count>,<line1>,<line2>,shellasync#GetPidList(<f-args>))
 command! -complete=customlist,<SID>ShellPidCompletion -nargs=? ShellSelect call shellasync#ShellSelect(<f-args>)
+command! -nargs=? ShellPage call shellasync#SpoolPage(<f-args>)
+command! -nargs=1 ShellSearch call shellasync#SpoolSearch(<q-args>)
+command! -nargs=? ShellTrace call shellasync#Trace(<f-args>)
+command! -nargs=1 -complete=file ShellTraceDump call shellasync#TraceDump(<q-args>)
 command! ShellSelected call shellasync#ShellSelected(bufnr('%'))
 command! ShellList call shellasync#OpenShellsList(0)
 command! ShellTerminal call shellasync#OpenShellTerminal()
 au VimLeavePre * if g:shellasync_loaded | exe 'pythonx shellasync.ShellAsyncTermAllCmds()' | endif
+au ColorScheme * if g:shellasync_loaded | exe 'pythonx shellasync.ShellAsyncAnsiReset()' | endif
 " }}}
 
 let &cpo = s:save_cpo
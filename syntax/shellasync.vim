@@ -18,8 +18,10 @@ set cpo&vim
 
 syntax match ShellAsyncRetVal /^Shell command / 
 syntax match ShellAsyncRetVal / completed with return value / 
+syntax match ShellAsyncDropped /\%1l^\[shellasync: .*\]$/
 
 highlight default link ShellAsyncRetVal   Comment
+highlight default link ShellAsyncDropped   Comment
 
 let b:current_syntax = "shellasync"
 
@@ -26,6 +26,8 @@ syntax match ShellAsyncListTitle /to select shell/
 syntax match ShellAsyncListColumn /Status/ 
 syntax match ShellAsyncListColumn /Return/ 
 syntax match ShellAsyncListColumn /PID/ 
+syntax match ShellAsyncListColumn /Rate/ 
+syntax match ShellAsyncListColumn /First/ 
 syntax match ShellAsyncListColumn /Command/ 
 syntax match ShellAsyncListInfo  / list of running processes / 
 syntax match ShellAsyncListInfo /No running processes/ 
@@ -33,6 +35,12 @@ syntax match ShellAsyncListPID / -\?[0-9]\+ /
 syntax match ShellAsyncListPID / - / 
 syntax match ShellAsyncListStatus /Running/ 
 syntax match ShellAsyncListStatus /Finished/ 
+syntax match ShellAsyncListStatus /Stopping/ 
+syntax match ShellAsyncListStatus /Terminated/ 
+syntax match ShellAsyncListStatus /Killed/ 
+syntax match ShellAsyncListStatus /^Evicted/ 
+syntax match ShellAsyncListInfo /(output no longer available)$/ 
+syntax match ShellAsyncListStatus /^Send [0-9]\+%/ 
 
 highlight default link ShellAsyncListTitle    Comment
 highlight default link ShellAsyncListColumn   String
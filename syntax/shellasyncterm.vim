@@ -19,9 +19,11 @@ set cpo&vim
 syntax match ShellAsyncTermRetVal /^Shell command / 
 syntax match ShellAsyncTermRetVal / completed with return value / 
 syntax match ShellAsyncTermPrompt /^$ / 
+syntax match ShellAsyncTermDropped /\%1l^\[shellasync: .*\]$/
 
 highlight default link ShellAsyncTermPrompt    Identifier
 highlight default link ShellAsyncTermRetVal   Comment
+highlight default link ShellAsyncTermDropped   Comment
 
 let b:current_syntax = "shellasyncterm"
 